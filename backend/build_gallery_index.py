@@ -0,0 +1,82 @@
+## build_gallery_index.py
+# Build the approximate nearest-neighbor (IVF) index of the gallery encodings offline, for
+# "gallery_index": "ivf" in config.json, and measure its recall@k against the exact search
+
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+
+from lib.evaluation import get_gallery_encodings_set, get_encodings_set, build_gallery_representations
+from lib.gallery_index import IVFGalleryIndex, measure_recall
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build the IVF gallery index and measure its recall@k')
+    parser.add_argument('--metadata', default=os.path.join('data', 'image_gene_and_syndrome_metadata_20082024.p'),
+                        help='Metadata pickle used by the service to select the gallery images.')
+    parser.add_argument('--output', default=os.path.join('data', 'gallery_index', 'gallery_ivf.npz'),
+                        help='Path of the index file (ivf_index_path in config.json).')
+    parser.add_argument('--n_lists', type=int, default=256,
+                        help='Number of k-means lists (default: 256, roughly sqrt of the gallery size or more).')
+    parser.add_argument('--n_iter', type=int, default=20, help='k-means iterations (default: 20).')
+    parser.add_argument('--max_train', type=int, default=50000,
+                        help='Number of gallery images used to train k-means (default: 50000).')
+    parser.add_argument('--seed', type=int, default=1000, help='Random seed (default: 1000).')
+    parser.add_argument('--skip_build', action='store_true',
+                        help='Only measure the recall of the existing index in --output.')
+    parser.add_argument('--case_input', default=None,
+                        help='Encodings (.pkl/.csv file or dir) of test images to measure the recall with. '
+                             'Default: --n_queries random gallery images.')
+    parser.add_argument('--n_queries', type=int, default=500, help='Number of gallery images used as queries.')
+    parser.add_argument('--query_slices', type=int, default=3,
+                        help='Model/TTA slices of a query, 3 for /predict without TTA (default: 3).')
+    parser.add_argument('--k', type=int, default=10, help='Recall@k (default: 10).')
+    parser.add_argument('--n_probe', default='1,2,4,8,16,32',
+                        help='Comma-separated n_probe values (ivf_n_probe in config.json) to measure.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    with open(args.metadata, "rb") as f:
+        images_synds_dict = pickle.load(f)["disorder_level_metadata"]
+    gallery_df = get_gallery_encodings_set(images_synds_dict)
+    gallery_representations = build_gallery_representations(gallery_df)
+    img_names = gallery_df["img_name"].values
+    print(f"Gallery: {gallery_representations.shape[1]} images, {gallery_representations.shape[0]} slices")
+
+    if args.skip_build:
+        index = IVFGalleryIndex.load(args.output, img_names)
+    else:
+        start_time = time.time()
+        index = IVFGalleryIndex.build(gallery_representations, img_names, args.n_lists, args.n_iter,
+                                      args.max_train, seed=args.seed)
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        index.save(args.output)
+        print(f"Built index with {index.n_lists} lists in {time.time() - start_time:.1f}s: {args.output}")
+
+    # queries: test encodings, or gallery images (their own image is excluded by the distance threshold)
+    if args.case_input:
+        case_df = get_encodings_set(args.case_input)
+        case_representations = np.stack(case_df.representations.values)
+    else:
+        rng = np.random.default_rng(args.seed)
+        rows = rng.choice(len(img_names), min(args.n_queries, len(img_names)), replace=False)
+        case_representations = np.transpose(gallery_representations[:, rows], (1, 0, 2))
+    case_representations = case_representations[:, :args.query_slices]
+
+    print(f"Recall@{args.k} over {len(case_representations)} queries:")
+    for n_probe in [int(n) for n in args.n_probe.split(',')]:
+        index.n_probe = n_probe
+        result = measure_recall(gallery_representations, index, case_representations, args.k, threshold=0.4)
+        print(f"n_probe {n_probe:4d}: recall {result['recall']:.4f}, "
+              f"searched {100 * result['searched_fraction']:.1f}% of the gallery, "
+              f"exact {result['exact_time']:.2f}s, index {result['index_time']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+## convert_gallery_encodings.py
+# Convert the pickled gallery encodings into the memory-mapped gallery matrix (.npy + _index.npz)
+# that the service opens at startup instead, see "gallery_matrix_path" in config.json
+
+import argparse
+import os
+import pickle
+import time
+
+from lib.evaluation import GALLERY_ENCODINGS_PATH, get_gallery_encodings_set, build_gallery_representations, \
+    build_gallery_labels
+from lib.gallery_store import index_path, load_gallery_matrix, metadata_fingerprint, save_gallery_matrix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert the gallery encodings pickle to a memory-mapped matrix')
+    parser.add_argument('--input', default=GALLERY_ENCODINGS_PATH,
+                        help='Gallery encodings (.pkl/.csv file or dir) to convert.')
+    parser.add_argument('--metadata', default=os.path.join('data', 'image_gene_and_syndrome_metadata_20082024.p'),
+                        help='Metadata pickle used by the service to select the gallery images and their labels.')
+    parser.add_argument('--output', default=os.path.join('data', 'gallery_encodings',
+                                                         'GMDB_gallery_encodings_20082024_v1.1.0_service.npy'),
+                        help='Path of the .npy matrix (gallery_matrix_path in config.json); '
+                             'the index is written next to it as <name>_index.npz.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    with open(args.metadata, "rb") as f:
+        metadata_bytes = f.read()
+    data = pickle.loads(metadata_bytes)
+
+    start_time = time.time()
+    gallery_df = get_gallery_encodings_set(data["disorder_level_metadata"], args.input)
+    gallery_representations = build_gallery_representations(gallery_df)
+    gallery_labels = build_gallery_labels(gallery_df, data["disorder_level_metadata"], data["gene_level_metadata"])
+    print(f"Read {args.input} in {time.time() - start_time:.1f}s")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    save_gallery_matrix(args.output, gallery_representations, gallery_df["img_name"].values, gallery_labels,
+                        metadata_fingerprint(metadata_bytes))
+
+    start_time = time.time()
+    load_gallery_matrix(args.output, metadata_fingerprint(metadata_bytes))
+    print(f"Wrote {args.output} and {index_path(args.output)}, "
+          f"which load in {1000 * (time.time() - start_time):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
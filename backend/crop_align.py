@@ -17,7 +17,7 @@ from lib.models.retinaface import RetinaFace
 import torch.backends.cudnn as cudnn
 from skimage import transform as trans
 
-from lib.utils.prior_box import PriorBox
+from lib.utils.prior_box import get_priors
 from lib.utils.box_utils import decode, decode_landm
 from lib.utils.py_cpu_nms import py_cpu_nms
 
@@ -164,10 +164,8 @@ def detect(net, img_path, img_name, device, save_dir='', first=False):
         loc, conf, landms = net(img)  # forward pass
     # print('net forward time on {}: {:.4f}'.format(img_path, time.time() - tic))
 
-    priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-    priors = priorbox.forward()
-    priors = priors.to(device)
-    prior_data = priors.data
+    # the priors only depend on the input size, so they are generated once per (height, width)
+    prior_data = get_priors(cfg, (im_height, im_width), device)
     boxes = decode(loc.data.squeeze(0), prior_data, cfg['variance'])
     boxes = boxes * scale / resize
     boxes = boxes.cpu().numpy()
@@ -0,0 +1,18 @@
+## gunicorn.conf.py
+# Preload-then-fork: the gunicorn master loads the models, metadata and gallery once, then forks the uvicorn
+# workers, which share these pages copy-on-write instead of each loading its own copy (see main.preload_shared_resources)
+# Run: gunicorn -c gunicorn.conf.py main:app
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'uvicorn_worker.UvicornWorker'
+# import main:app in the master before forking
+preload_app = True
+
+
+def when_ready(server):
+    # runs in the master after the app is imported and before the first worker is forked
+    import main
+    main.preload_shared_resources()
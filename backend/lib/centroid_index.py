@@ -0,0 +1,70 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from lib.evaluation import compute_mean_dists, normalize_case_representations
+from lib.gallery_index import GalleryIndex, members_of_nearest
+
+
+def _group_centroids(gallery_representations: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Mean representation per label, over all model/tta slices.
+
+    Returns:
+        (centroids [model/tta, n_labels, dim] L2-normalized, members, members_indptr): the gallery rows of
+        label j are members[members_indptr[j]:members_indptr[j + 1]].
+    """
+    unique_labels, label_pos = np.unique(labels, return_inverse=True)
+    counts = np.bincount(label_pos, minlength=len(unique_labels))
+    n_gallery = len(labels)
+
+    # sparse [n_labels, n_gallery] averaging matrix, one sparse x dense product per slice
+    averaging = sp.csr_matrix((1.0 / counts[label_pos], (label_pos, np.arange(n_gallery))),
+                              shape=(len(unique_labels), n_gallery), dtype=np.float32)
+    centroids = np.stack([averaging @ representations for representations in gallery_representations])
+    norms = np.linalg.norm(centroids, axis=2, keepdims=True)
+    centroids = np.ascontiguousarray(centroids / np.maximum(norms, np.finfo(np.float32).eps), dtype=np.float32)
+
+    members = np.argsort(label_pos, kind="stable")
+    members_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return centroids, members, members_indptr
+
+
+class CentroidIndex(GalleryIndex):
+    """
+    Syndrome and patient centroids of the gallery, used to pre-filter the image-level search.
+
+    A query is first compared with the centroid (mean of the L2-normalized representations of all
+    model/tta slices) of every syndrome and every patient. Only the gallery images of the n_synds
+    nearest syndromes and the n_subjects nearest patients are then searched image by image, see
+    evaluate(candidate_idx=...). Syndromes, genes and patients outside these candidates are not ranked.
+    """
+
+    name = "centroid"
+
+    def __init__(self, gallery_representations: np.ndarray, gallery_labels: Dict[str, np.ndarray],
+                 n_synds: int = 50, n_subjects: int = 100):
+        self.n_synds = n_synds
+        self.n_subjects = n_subjects
+        self.synd_centroids, self._synd_members, self._synd_indptr = _group_centroids(
+            gallery_representations, gallery_labels['synds'])
+        self.subject_centroids, self._subject_members, self._subject_indptr = _group_centroids(
+            gallery_representations, gallery_labels['subjects'])
+        print(f"Built centroid index: {self.synd_centroids.shape[1]} syndromes, "
+              f"{self.subject_centroids.shape[1]} patients")
+
+    def candidates(self, case_representations: np.ndarray) -> List[np.ndarray]:
+        """
+        Sorted candidate gallery rows per test image.
+
+        Args:
+            case_representations: [test_img, model/tta, dim] representations of the test images.
+        """
+        case_representations = normalize_case_representations(case_representations)
+        synd_dists = compute_mean_dists(self.synd_centroids, case_representations)
+        subject_dists = compute_mean_dists(self.subject_centroids, case_representations)
+        return [np.union1d(members_of_nearest(synd_dist, self.n_synds, self._synd_members, self._synd_indptr),
+                           members_of_nearest(subject_dist, self.n_subjects,
+                                              self._subject_members, self._subject_indptr))
+                for synd_dist, subject_dist in zip(synd_dists, subject_dists)]
@@ -0,0 +1,82 @@
+import threading
+import time
+from typing import Any, Dict
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while.
+
+    After failure_threshold consecutive failures the breaker trips (state 'open') and
+    allow_request() returns False for cooldown seconds. Afterwards a single probe call is let
+    through ('half_open'); its success closes the breaker, its failure trips it again. Other
+    calls are rejected while the probe runs, or until it is cooldown seconds old. Every call
+    let through must record exactly one success, failure or client error. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow_request(self) -> bool:
+        """Whether the service may be called now; counts the rejected calls."""
+        with self._lock:
+            state = self.state
+            if state == "half_open":
+                now = time.monotonic()
+                if self._probe_started is None or now - self._probe_started >= self.cooldown:
+                    self._probe_started = now
+                    return True
+            if state != "closed":
+                self.rejected += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_client_error(self):
+        # the call failed because of its request (e.g. HTTP 4xx), which says nothing about the service:
+        # the failure counter is kept, and a probe rejected this way lets the next call probe
+        with self._lock:
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or (self.state == "closed"
+                                             and self.consecutive_failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+                self.trips += 1
+                print(f"Circuit breaker tripped after {self.consecutive_failures} consecutive failures")
+
+    def stats(self) -> Dict[str, Any]:
+        """Current state, failure and trip counters."""
+        with self._lock:
+            return {"state": self.state,
+                    "consecutive_failures": self.consecutive_failures,
+                    "trips": self.trips,
+                    "rejected": self.rejected}
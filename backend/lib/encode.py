@@ -2,12 +2,32 @@ import cv2
 import torch
 import random
 import numpy as np
-import pandas as pd
 import albumentations as A
 import torch.backends.cudnn as cudnn
 
+from typing import NamedTuple, List
 from onnx2torch import convert
 
+
+class Encoding(NamedTuple):
+    # Encodings of one image: one row per model/tta with the model, flip and gray index of each row
+    representations: np.ndarray  # [model/tta, dim] float32
+    model: np.ndarray
+    flip: np.ndarray
+    gray: np.ndarray
+    class_conf: List[np.ndarray]
+    img_name: str = 'input'
+
+    def to_dict(self):
+        # Same layout as DataFrame.to_dict() of the former encoding DataFrame
+        rows = range(len(self.representations))
+        return {"img_name": {i: self.img_name for i in rows},
+                "model": {i: f"m{self.model[i]}" for i in rows},
+                "flip": {i: int(self.flip[i]) for i in rows},
+                "gray": {i: int(self.gray[i]) for i in rows},
+                "class_conf": {i: np.asarray(self.class_conf[i]).tolist() for i in rows},
+                "representations": {i: self.representations[i].tolist() for i in rows}}
+
 def preprocess(img, img_size=112, gray=False, flip=False):
     img = cv2.resize(img, (img_size, img_size))
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -28,9 +48,44 @@ def preprocess(img, img_size=112, gray=False, flip=False):
     return img
 
 
+def preprocess_tta(img, img_size=112, flip_modes=(False, True), gray_modes=(False, True)):
+    # Same as preprocess, but resizes once and stacks all flip/gray variants into one batch
+    # -> [n_tta, 3, img_size, img_size] with tta_modes = [(flip, gray), ...] in the same order
+    img = cv2.resize(img, (img_size, img_size))
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    imgs = []
+    tta_modes = []
+    for flip in flip_modes:
+        for gray in gray_modes:
+            img_p = A.to_gray(img) if gray else img
+            if flip:
+                img_p = A.hflip(img_p)
+            imgs.append(np.transpose(img_p, (2, 0, 1)))
+            tta_modes.append((flip, gray))
+
+    # normalize pixel values in range [-1,1]
+    imgs = torch.from_numpy(np.stack(imgs)).float()
+    imgs.div_(255).sub_(0.5).div_(0.5)
+    return imgs, tta_modes
+
+
+def forward_tta(model, imgs):
+    # Single forward pass over the TTA batch -> class_conf [n_tta, n_classes] (None for onnx),
+    # representations [n_tta, dim]
+    output = model(imgs)
+    if torch.is_tensor(output):  # type == onnx --> 1 output: pred_rep
+        return None, output
+    pred, pred_rep = output
+    return pred, pred_rep
+
+
 def encode(models, device, img, flip_flag=True, gray_flag=True):
-    # initialize result
-    result = pd.DataFrame(columns=["img_name", "model", "flip", "gray", "class_conf", "representations"])
+    return encode_batch(models, device, [img], flip_flag, gray_flag)[0]
+
+
+def encode_batch(models, device, imgs, flip_flag=True, gray_flag=True):
+    # Encode several aligned images with one forward pass per model -> one Encoding per image
     if flip_flag:
         flip_modes = [False, True]
     else:
@@ -39,28 +94,34 @@ def encode(models, device, img, flip_flag=True, gray_flag=True):
         gray_modes = [False, True]
     else:
         gray_modes = [False]
-    img_name = 'input'
+
+    # preprocess all flip/gray variants once and run them through each model as one batch
+    # -> [img * tta, 3, 112, 112]
+    batch = [preprocess_tta(img, flip_modes=flip_modes, gray_modes=gray_modes) for img in imgs]
+    tta_modes = batch[0][1]
+    n_imgs, n_tta = len(imgs), len(tta_modes)
+    img_p = torch.cat([img_p for img_p, _ in batch]).to(device, dtype=torch.float32)
+    representations = []
+    class_conf = []
     with torch.no_grad():
         for idx, model in enumerate(models):
-            for flip in flip_modes:
-                for gray in gray_modes:
-                    img_p = preprocess(img,
-                                       gray=gray,
-                                       flip=flip
-                                       ).to(device, dtype=torch.float32)
-
-                    _pred_rep = model(img_p)
-                    if len(_pred_rep) == 1:  # type == onnx --> 1 output: pred_rep
-                        pred = [0]
-                    else:
-                        pred, _pred_rep = _pred_rep
-                        pred = pred.squeeze().tolist()
-
-                    # its overwriting right now
-                    result.loc[len(result)] = [img_name, f"m{idx}", int(flip), int(gray), pred,
-                                               _pred_rep.squeeze().tolist()]
-
-    return result
+            preds, _pred_reps = forward_tta(model, img_p)
+            representations.append(_pred_reps.cpu().numpy().reshape(n_imgs, n_tta, -1))
+            if preds is None:
+                class_conf.append(np.zeros((n_imgs, n_tta, 1), dtype=np.float32))
+            else:
+                class_conf.append(preds.cpu().numpy().reshape(n_imgs, n_tta, -1))
+
+    n_models = len(models)
+    encodings = []
+    for i in range(n_imgs):
+        encodings.append(Encoding(
+            representations=np.concatenate([r[i] for r in representations]).astype(np.float32, copy=False),
+            model=np.repeat(np.arange(n_models), n_tta),
+            flip=np.tile([int(flip) for flip, _ in tta_modes], n_models),
+            gray=np.tile([int(gray) for _, gray in tta_modes], n_models),
+            class_conf=[conf for model_conf in class_conf for conf in model_conf[i]]))
+    return encodings
 
 
 def get_models():
@@ -6,59 +6,118 @@ import random
 import numpy as np
 import pandas as pd
 
-from sklearn.metrics import pairwise_distances
-
     
-def evaluate(all_df, case_df, gallery='all', threshold=None):
-    # Get representations of just the gallery set
-    gallery_set_representations = all_df.representations.values
-    gallery_set_representations = np.stack(gallery_set_representations)
-
-    # Get representations of just the gallery set
-    case_representations = case_df.representations.values
-    case_representations = np.stack([case_representations])
+def build_gallery_representations(gallery_df):
+    # Stack the gallery once into a contiguous float32 tensor -> [model/tta, img, dim]
+    # and L2-normalize each row, so a query only needs a matmul to get the cosine similarities
+    representations = np.stack(gallery_df.representations.values).astype(np.float32)
+    representations = np.ascontiguousarray(np.transpose(representations, (1, 0, 2)))
+    norms = np.linalg.norm(representations, axis=2, keepdims=True)
+    representations /= np.maximum(norms, np.finfo(np.float32).eps)
+    return representations
+
+
+def normalize_case_representations(case_representations):
+    # [test_img, model/tta, dim] -> L2-normalized float32
+    case_representations = np.asarray(case_representations, dtype=np.float32)
+    norms = np.linalg.norm(case_representations, axis=2, keepdims=True)
+    return case_representations / np.maximum(norms, np.finfo(np.float32).eps)
+
+
+def evaluate(all_df, case_df, gallery='all', threshold=None, gallery_representations=None,
+             top_k=None, count_unique=None, return_index=False, candidate_idx=None):
+    # Get representations of just the gallery set, precomputed at startup in the service
+    if gallery_representations is None:
+        gallery_representations = build_gallery_representations(all_df)
+
+    # Get representations of the test image(s) -> [test_img, model/tta, dim]
+    # case_df is the encodings of one image, or a list of them to evaluate several images at once
+    if isinstance(case_df, (list, tuple)):
+        case_representations = np.stack([get_case_representations(df) for df in case_df])
+    else:
+        case_representations = get_case_representations(case_df)[np.newaxis]
+    case_representations = normalize_case_representations(case_representations)
 
     # Actually get distances
     def eval(gallery_df, gallery_set_representations, test_set_representations, threshold=None):
-        def reshape_representations(representations):
-            representations = [
-                np.array([representations[j][i] for j in range(len(representations))]) for i in
-                range(len(representations[0]))]
-            return representations
-
-        # have to reshape the array manually due to different size repr.vec. -> [model/tta, img, [1,dim]]
-        test_set_representations = reshape_representations(test_set_representations)
-        gallery_set_representations = reshape_representations(gallery_set_representations)
-
-        # Per img, per model/tta sorted min distance from test to gallery(index)
-        dists = np.stack(
-            [pairwise_distances(test_set_representations[model_tta], gallery_set_representations[model_tta], 'cosine')
-             for model_tta in range(len(test_set_representations))], axis=1)
-
-        # average the distances over all models
-        mean_dists = np.mean(dists, axis=1)
-
-        # Condense the model-axis to end up with 1 vote per image, rather than 1 vote per model per image
-        # It was designed for testing a batch of images, however, we only support analysis of one image
-        # in the service.
-        # mean_dists = [[mean_dist of test_image_1], [mean_dist of test_image_2], [mean_dist of test_image_n]]
-        # len(mean_dist of test_image_1) == gallery size
-        if threshold != None:
-            print('filter {}'.format(threshold))
-            filtered_idx_list = [filter_by_distance(mean_dist, threshold) for mean_dist in mean_dists]
-            ranked_mean_dists = [mean_dist[filtered_idx] for mean_dist, filtered_idx in
-                                 zip(mean_dists, filtered_idx_list)]
-            ranked_img_ids = [gallery_df["img_name"].values[filtered_idx] for filtered_idx in filtered_idx_list]
+        if candidate_idx is not None:
+            # Only compare each test image with its candidate gallery images (e.g. of CentroidIndex.candidates),
+            # the ranked indices are mapped back to gallery rows
+            img_names = gallery_df["img_name"].values
+            ranked_mean_dists, ranked_img_ids, filtered_idx_list = [], [], []
+            for i, rows in enumerate(candidate_idx):
+                rows = np.asarray(rows, dtype=np.int64)
+                # slice the model/tta axis first, so only the slices compared with the query are copied
+                n_model_tta = test_set_representations.shape[1]
+                mean_dist = compute_mean_dists(gallery_set_representations[:n_model_tta, rows],
+                                               test_set_representations[i:i + 1])[0]
+                if top_k != None:
+                    count_rows = None if count_unique is None else lambda ranked_idx: count_unique(rows[ranked_idx])
+                    local_idx = rank_top_k(mean_dist, top_k, threshold, count_rows)
+                elif threshold != None:
+                    local_idx = filter_by_distance(mean_dist, threshold)
+                else:
+                    local_idx = np.argsort(mean_dist)
+                ranked_mean_dists.append(mean_dist[local_idx])
+                filtered_idx_list.append(rows[local_idx])
+                ranked_img_ids.append(img_names[rows[local_idx]])
+            print('Candidates {} (filter {})'.format([len(rows) for rows in candidate_idx], threshold))
         else:
-            print('No filter {}'.format(threshold))
-            ranked_dist_index = np.argsort(mean_dists, axis=1)
-            ranked_mean_dists = np.take_along_axis(mean_dists, ranked_dist_index, axis=1)
-            ranked_img_ids = gallery_df["img_name"].values[ranked_dist_index]
-
+            mean_dists = compute_mean_dists(gallery_set_representations, test_set_representations)
+
+            # Condense the model-axis to end up with 1 vote per image, rather than 1 vote per model per image
+            # It was designed for testing a batch of images, which the service uses for /predict/batch.
+            # mean_dists = [[mean_dist of test_image_1], [mean_dist of test_image_2], [mean_dist of test_image_n]]
+            # len(mean_dist of test_image_1) == gallery size
+            if top_k != None:
+                # Only rank the nearest images, widening until count_unique(ranked_idx) reaches top_k
+                print('Top-{} (filter {})'.format(top_k, threshold))
+                filtered_idx_list = [rank_top_k(mean_dist, top_k, threshold, count_unique) for mean_dist in mean_dists]
+                ranked_mean_dists = [mean_dist[filtered_idx] for mean_dist, filtered_idx in
+                                     zip(mean_dists, filtered_idx_list)]
+                ranked_img_ids = [gallery_df["img_name"].values[filtered_idx] for filtered_idx in filtered_idx_list]
+            elif threshold != None:
+                print('filter {}'.format(threshold))
+                filtered_idx_list = [filter_by_distance(mean_dist, threshold) for mean_dist in mean_dists]
+                ranked_mean_dists = [mean_dist[filtered_idx] for mean_dist, filtered_idx in
+                                     zip(mean_dists, filtered_idx_list)]
+                ranked_img_ids = [gallery_df["img_name"].values[filtered_idx] for filtered_idx in filtered_idx_list]
+            else:
+                print('No filter {}'.format(threshold))
+                ranked_dist_index = np.argsort(mean_dists, axis=1)
+                ranked_mean_dists = np.take_along_axis(mean_dists, ranked_dist_index, axis=1)
+                ranked_img_ids = gallery_df["img_name"].values[ranked_dist_index]
+                filtered_idx_list = ranked_dist_index
+
+        # ranked gallery row indices, used to look up the precomputed gallery labels
+        if return_index:
+            return ranked_mean_dists, ranked_img_ids, filtered_idx_list
         return ranked_mean_dists, ranked_img_ids
 
     # return ranked_mean_dists, ranked_img_ids
-    return eval(all_df, gallery_set_representations, case_representations, threshold)
+    return eval(all_df, gallery_representations, case_representations, threshold)
+
+
+def compute_mean_dists(gallery_representations, case_representations):
+    # Per model/tta cosine distance from test to gallery: the rows are already normalized,
+    # so this is a single batched matmul -> [model/tta, test_img, gallery_img]
+    n_model_tta = case_representations.shape[1]
+    similarities = np.matmul(np.transpose(case_representations, (1, 0, 2)),
+                             np.transpose(gallery_representations[:n_model_tta], (0, 2, 1)))
+
+    # average the distances over all models -> [test_img, gallery_img]
+    return np.clip(1.0 - np.mean(similarities, axis=0), 0.0, 2.0)
+
+
+def get_case_representations(case_df):
+    # [model/tta, dim] representations of one image's encodings (Encoding, DataFrame or the array itself)
+    if isinstance(case_df, np.ndarray):
+        return case_df
+    case_representations = case_df.representations
+    if not isinstance(case_representations, np.ndarray):
+        # encodings as DataFrame
+        case_representations = np.stack(case_representations.values)
+    return case_representations
 
 
 def filter_by_distance(distances, thresh=0.1):
@@ -67,6 +126,131 @@ def filter_by_distance(distances, thresh=0.1):
     return idx[np.argsort(distances[idx])]
 
 
+def rank_top_k(distances, k, thresh=None, count_unique=None):
+    # Partial version of filter_by_distance/argsort: only the k nearest images are sorted.
+    # If count_unique is given, k is doubled until the ranked images cover k unique entries
+    if thresh != None:
+        idx, = np.where(distances > thresh)
+    else:
+        idx = np.arange(len(distances))
+
+    n = k
+    while True:
+        if n >= len(idx):
+            ranked_idx = idx[np.argsort(distances[idx])]
+            break
+        part_idx = idx[np.argpartition(distances[idx], n - 1)[:n]]
+        ranked_idx = part_idx[np.argsort(distances[part_idx])]
+        if count_unique is None or count_unique(ranked_idx) >= k:
+            break
+        n *= 2
+    return ranked_idx
+
+
+def count_first_unique(ranked_img_ids, images_synds_dict, images_genes_dict):
+    # Smallest number of unique syndromes, genes and subjects among the ranked images
+    synds = set()
+    genes = set()
+    subjects = set()
+    for image_id in ranked_img_ids:
+        synds.add(images_synds_dict[int(image_id)]['disorder_internal_id'])
+        image_genes = images_genes_dict[int(image_id)]
+        genes.update(gene['gene_internal_id'] for gene in image_genes)
+        subjects.add(image_genes[0]['patient_id'])
+    return min(len(synds), len(genes), len(subjects))
+
+
+def count_first_unique_labels(ranked_idx, gallery_labels):
+    # Same as count_first_unique, on the label arrays of build_gallery_labels
+    genes_indptr = gallery_labels['genes_indptr']
+    ranked_genes = [gallery_labels['genes'][genes_indptr[i]:genes_indptr[i + 1]] for i in ranked_idx]
+    ranked_genes = np.concatenate(ranked_genes) if len(ranked_genes) > 0 else []
+    return min(len(np.unique(gallery_labels['synds'][ranked_idx])),
+               len(np.unique(ranked_genes)),
+               len(np.unique(gallery_labels['subjects'][ranked_idx])))
+
+
+def build_gallery_labels(gallery_df, images_synds_dict, images_genes_dict):
+    # Integer label arrays aligned with the gallery rows: image->disorder, image->patient and a
+    # CSR-style image->genes mapping (genes of row i are genes[genes_indptr[i]:genes_indptr[i + 1]])
+    image_ids = [int(image_id) for image_id in gallery_df["img_name"].values]
+    image_genes = [[gene['gene_internal_id'] for gene in images_genes_dict[image_id]] for image_id in image_ids]
+    gallery_labels = {
+        'synds': np.array([images_synds_dict[image_id]['disorder_internal_id'] for image_id in image_ids]),
+        'genes': np.array([gene for genes in image_genes for gene in genes]),
+        'genes_indptr': np.concatenate([[0], np.cumsum([len(genes) for genes in image_genes])]).astype(np.int64),
+        'subjects': np.array([images_genes_dict[image_id][0]['patient_id'] for image_id in image_ids])
+    }
+    print("Build gallery labels")
+    return gallery_labels
+
+
+def get_first_labels(ranked_mean_dists_list, ranked_img_ids_list, ranked_idx_list, labels, labels_indptr=None):
+    # Vectorized get_first_synds/get_first_genes/get_first_subject on the gallery label arrays.
+    # labels_indptr is given when an image can have multiple labels (genes)
+    img_labels_results_list = []
+    img_dists_results_list = []
+    img_image_results_list = []
+
+    for ranked_idx, ranked_img_ids, ranked_mean_dists in zip(ranked_idx_list, ranked_img_ids_list,
+                                                               ranked_mean_dists_list):
+        ranked_idx = np.asarray(ranked_idx, dtype=np.int64)
+        if labels_indptr is None:
+            ranked_labels = labels[ranked_idx]
+            ranked_pos = np.arange(len(ranked_idx))
+        else:
+            # expand every ranked image to its labels, keeping the rank position of the image
+            starts = labels_indptr[ranked_idx]
+            counts = labels_indptr[ranked_idx + 1] - starts
+            ranked_pos = np.repeat(np.arange(len(ranked_idx)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            ranked_labels = labels[np.repeat(starts, counts) + offsets]
+
+        sort_index = np.sort(np.unique(ranked_labels, return_index=True)[1])
+        first_pos = ranked_pos[sort_index]
+        img_labels_results_list.append(ranked_labels[sort_index])
+        img_dists_results_list.append(np.asarray(ranked_mean_dists)[first_pos])
+        img_image_results_list.append(np.asarray(ranked_img_ids)[first_pos])
+    img_labels_results_list = np.array(img_labels_results_list)
+    img_dists_results_list = np.array(img_dists_results_list)
+    img_image_results_list = np.array(img_image_results_list)
+
+    return img_labels_results_list, img_dists_results_list, img_image_results_list
+
+
+def get_late_fused_labels(mean_dists, img_names, labels, labels_indptr=None, threshold=None):
+    # Late fusion of several test images of one patient (exp_late_fuse_test in evaluate_ensemble_multi_image):
+    # the distance of a label is the mean over the test images of the distance of its nearest gallery image.
+    # Returns the labels ordered by that distance, with the gallery image of the closest single match
+    if labels_indptr is None:
+        rows = np.arange(len(labels))
+    else:
+        rows = np.repeat(np.arange(len(labels_indptr) - 1), np.diff(labels_indptr))
+    unique_labels, label_pos = np.unique(labels, return_inverse=True)
+    dists = mean_dists[:, rows]
+    if threshold != None:
+        dists = np.where(dists > threshold, dists, np.inf)
+
+    # nearest gallery image per label and test image: the first entry per label when sorted by (label, distance)
+    best_dists = np.empty((len(dists), len(unique_labels)))
+    best_rows = np.empty((len(dists), len(unique_labels)), dtype=np.int64)
+    for i, image_dists in enumerate(dists):
+        order = np.lexsort((image_dists, label_pos))
+        first = order[np.unique(label_pos[order], return_index=True)[1]]
+        best_dists[i] = image_dists[first]
+        best_rows[i] = rows[first]
+
+    # average over the test images where the label was not filtered out by the threshold
+    valid = np.isfinite(best_dists)
+    counts = valid.sum(axis=0)
+    fused_dists = np.where(valid, best_dists, 0).sum(axis=0) / np.maximum(counts, 1)
+    closest_rows = best_rows[np.argmin(best_dists, axis=0), np.arange(len(unique_labels))]
+
+    keep, = np.where(counts > 0)
+    keep = keep[np.argsort(fused_dists[keep], kind='stable')]
+    return unique_labels[keep], fused_dists[keep], np.asarray(img_names)[closest_rows[keep]]
+
+
 def get_first_synds(ranked_mean_dists_list, ranked_img_ids_list, images_synds_dict, verbose=False):
     # This removes all duplicate occurrences except for the first one.. for each test image
     img_synds_results_list = []
@@ -269,9 +453,11 @@ def save_to_json(results, output_dir, output_file):
         json.dump(results, f, indent=4, sort_keys=True)
 
 
-def get_gallery_encodings_set(images_synds_dict):
+GALLERY_ENCODINGS_PATH = os.path.join('data', 'gallery_encodings', 'GMDB_gallery_encodings_20082024_v1.1.0_service.pkl')
+
+
+def get_gallery_encodings_set(images_synds_dict, gallery_input=GALLERY_ENCODINGS_PATH):
     gallery_list = []
-    gallery_input = os.path.join('data', 'gallery_encodings', 'GMDB_gallery_encodings_20082024_v1.1.0_service.pkl')
     gallery_df = get_encodings_set(gallery_input, gallery_list)
     image_ids = [str(i) for i in images_synds_dict.keys()]
     gallery_df = gallery_df[gallery_df["img_name"].isin(image_ids)]
@@ -279,60 +465,96 @@ def get_gallery_encodings_set(images_synds_dict):
     return gallery_df
 
 
-def predict(test_df, _gallery_df, images_synds_dict, images_genes_dict, genes_metadata, synds_metadata):
+def predict(test_df, _gallery_df, images_synds_dict, images_genes_dict, genes_metadata, synds_metadata,
+            gallery_representations=None, top_n='all', gallery_labels=None, gallery_index=None):
+    return predict_batch([test_df], _gallery_df, images_synds_dict, images_genes_dict, genes_metadata,
+                         synds_metadata, gallery_representations, top_n, gallery_labels, gallery_index)[0]
+
+
+def predict_batch(test_dfs, _gallery_df, images_synds_dict, images_genes_dict, genes_metadata, synds_metadata,
+                  gallery_representations=None, top_n='all', gallery_labels=None, gallery_index=None):
+    # Same as predict for several images, with the distances to the gallery computed in one matmul
     start_time = time.time()
     # Seed everything
     np.random.seed(1000)
     torch.manual_seed(1000)
     random.seed(1000)
 
-    ### set input case file
-    case_df = test_df
+    ### set input case files
+    case_dfs = list(test_dfs)
     parse_finished_time = time.time()
 
     ## Evaluate
     # Get all synd_ids, dists, img_ids, subject_ids per image in gallery
-    top_n = 'all'
     if top_n == 'all':
         n = None
     else:
-        n = int(args.top_n)
-
-    all_ranks = evaluate(_gallery_df, case_df, "all", threshold=0.4)
-    # do we need np array?
-    #all_ranks = np.array(all_ranks)
+        n = int(top_n)
 
+    # With top_n, only rank as many images as needed to fill n unique syndromes, genes and subjects
+    if gallery_labels is not None:
+        count_unique = lambda ranked_idx: count_first_unique_labels(ranked_idx, gallery_labels)
+    else:
+        img_names = _gallery_df["img_name"].values
+        count_unique = lambda ranked_idx: count_first_unique(img_names[ranked_idx], images_synds_dict,
+                                                             images_genes_dict)
+    # With an approximate gallery index (see lib/gallery_index.py), only its candidate images are searched
+    candidate_idx = None
+    if gallery_index is not None:
+        candidate_idx = gallery_index.candidates(np.stack([get_case_representations(df) for df in case_dfs]))
+    ranked_mean_dists, ranked_img_ids, ranked_idx = evaluate(_gallery_df, case_dfs, "all", threshold=0.4,
+                                                             gallery_representations=gallery_representations,
+                                                             top_k=n, count_unique=count_unique,
+                                                             return_index=True, candidate_idx=candidate_idx)
     evaluate_finished_time = time.time()
 
-    # Get all synd_ids, dists, img_ids, subject_ids per syndrome in gallery
-    first_synd_ranks = get_first_synds(*all_ranks, images_synds_dict)
-    first_synd_ranks = np.array(first_synd_ranks)
-    get_synds_time = time.time()
+    outputs = []
+    for i in range(len(case_dfs)):
+        all_ranks = ([ranked_mean_dists[i]], [ranked_img_ids[i]])
+        # do we need np array?
+        #all_ranks = np.array(all_ranks)
 
-    # Get all synd_ids, dists, img_ids, subject_ids per syndrome in gallery
-    first_gene_ranks = get_first_genes(*all_ranks, images_genes_dict)
-    first_gene_ranks = np.array(first_gene_ranks)
-    get_genes_time = time.time()
+        # Get all synd_ids, dists, img_ids, subject_ids per syndrome in gallery
+        if gallery_labels is not None:
+            first_synd_ranks = get_first_labels(*all_ranks, [ranked_idx[i]], gallery_labels['synds'])
+        else:
+            first_synd_ranks = get_first_synds(*all_ranks, images_synds_dict)
+        first_synd_ranks = np.array(first_synd_ranks)
 
-    # Get all synd_ids, dists, img_ids, subject_ids per subject in gallery
-    first_subject_ranks = get_first_subject(*all_ranks, images_genes_dict)
-    first_subject_ranks = np.array(first_subject_ranks)
-    get_genes_time = time.time()
+        # Get all synd_ids, dists, img_ids, subject_ids per gene in gallery
+        if gallery_labels is not None:
+            first_gene_ranks = get_first_labels(*all_ranks, [ranked_idx[i]], gallery_labels['genes'],
+                                                gallery_labels['genes_indptr'])
+        else:
+            first_gene_ranks = get_first_genes(*all_ranks, images_genes_dict)
+        first_gene_ranks = np.array(first_gene_ranks)
 
-    case_id = 1
+        # Get all synd_ids, dists, img_ids, subject_ids per subject in gallery
+        if gallery_labels is not None:
+            first_subject_ranks = get_first_labels(*all_ranks, [ranked_idx[i]], gallery_labels['subjects'])
+        else:
+            first_subject_ranks = get_first_subject(*all_ranks, images_genes_dict)
+        first_subject_ranks = np.array(first_subject_ranks)
 
-    synd_output_list = format_syndrome_json(first_synd_ranks[:, :, :n], synds_metadata, images_synds_dict, case_id)
-    gene_output_list = format_gene_json(first_gene_ranks[:, :, :n], genes_metadata, images_genes_dict, case_id)
-    subject_output_list = format_subject_json(first_subject_ranks[:, :, :n], genes_metadata, images_genes_dict, case_id)
+        case_id = i + 1
 
+        outputs.append(format_output(first_synd_ranks, first_gene_ranks, first_subject_ranks, n, images_synds_dict,
+                                     images_genes_dict, genes_metadata, synds_metadata, case_id))
     output_finished_time = time.time()
 
     #print('Parse: {:.2f}s'.format(parse_finished_time-start_time))
     print('Evaluate: {:.2f}s'.format(evaluate_finished_time-parse_finished_time))
-    #print('Get synds: {:.2f}s'.format(get_synds_time-evaluate_finished_time))
-    #print('Get genes: {:.2f}s'.format(get_genes_time-get_synds_time))
-    #print('Format: {:.2f}s'.format(output_finished_time-get_genes_time))
+    #print('Format: {:.2f}s'.format(output_finished_time-evaluate_finished_time))
     #print('Total: {:.2f}s'.format(output_finished_time-start_time))
+    return outputs
+
+
+def format_output(first_synd_ranks, first_gene_ranks, first_subject_ranks, n, images_synds_dict, images_genes_dict,
+                  genes_metadata, synds_metadata, case_id=''):
+    synd_output_list = format_syndrome_json(first_synd_ranks[:, :, :n], synds_metadata, images_synds_dict, case_id)
+    gene_output_list = format_gene_json(first_gene_ranks[:, :, :n], genes_metadata, images_genes_dict, case_id)
+    subject_output_list = format_subject_json(first_subject_ranks[:, :, :n], genes_metadata, images_genes_dict, case_id)
+
     output = {"model_version": "v1.1.0",
               "gallery_version": "20.08.2024",
               "suggested_genes_list": gene_output_list,
@@ -340,3 +562,46 @@ def predict(test_df, _gallery_df, images_synds_dict, images_genes_dict, genes_me
               "suggested_patients_list": subject_output_list}
     return output
 
+
+def predict_patient(test_dfs, _gallery_df, images_synds_dict, images_genes_dict, genes_metadata, synds_metadata,
+                    gallery_representations=None, top_n='all', gallery_labels=None, fusion='mean',
+                    gallery_index=None):
+    # Predict one patient from the encodings of several images.
+    # fusion='mean': early fusion, the mean representation of the images is searched like a single image
+    # fusion='late': the per-image distances are fused per syndrome/gene/subject (see get_late_fused_labels)
+    case_representations = [get_case_representations(df) for df in test_dfs]
+    if fusion == 'mean':
+        fused_representations = np.mean(np.stack(case_representations), axis=0)
+        return predict(fused_representations, _gallery_df, images_synds_dict, images_genes_dict, genes_metadata,
+                       synds_metadata, gallery_representations, top_n, gallery_labels, gallery_index)
+    if fusion != 'late':
+        raise ValueError("Unknown fusion '{}', use 'mean' or 'late'".format(fusion))
+
+    start_time = time.time()
+    if gallery_representations is None:
+        gallery_representations = build_gallery_representations(_gallery_df)
+    if gallery_labels is None:
+        gallery_labels = build_gallery_labels(_gallery_df, images_synds_dict, images_genes_dict)
+    n = None if top_n == 'all' else int(top_n)
+
+    # all images of the patient against the gallery in one matmul -> [test_img, gallery_img]
+    case_representations = normalize_case_representations(case_representations)
+    candidate_idx = None if gallery_index is None else gallery_index.candidates(case_representations)
+    if candidate_idx is None:
+        mean_dists = compute_mean_dists(gallery_representations, case_representations)
+    else:
+        # only the candidates of any of the images, the other gallery images are left out (infinite distance)
+        rows = np.unique(np.concatenate(candidate_idx))
+        mean_dists = np.full((len(case_representations), gallery_representations.shape[1]), np.inf)
+        mean_dists[:, rows] = compute_mean_dists(gallery_representations[:case_representations.shape[1], rows],
+                                                 case_representations)
+    img_names = _gallery_df["img_name"].values
+    fused_ranks = []
+    for labels, labels_indptr in [(gallery_labels['synds'], None),
+                                  (gallery_labels['genes'], gallery_labels['genes_indptr']),
+                                  (gallery_labels['subjects'], None)]:
+        first_ranks = get_late_fused_labels(mean_dists, img_names, labels, labels_indptr, threshold=0.4)
+        fused_ranks.append(np.array(tuple(np.array([ranks]) for ranks in first_ranks)))
+    print('Late fusion of {} images: {:.2f}s'.format(len(case_representations), time.time() - start_time))
+
+    return format_output(*fused_ranks, n, images_synds_dict, images_genes_dict, genes_metadata, synds_metadata, 1)
@@ -0,0 +1,161 @@
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+
+from lib.evaluation import compute_mean_dists, normalize_case_representations, rank_top_k
+
+
+def members_of_nearest(dists: np.ndarray, n: int, members: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """Gallery rows of the n nearest groups; the rows of group j are members[indptr[j]:indptr[j + 1]]."""
+    if n < len(dists):
+        nearest = np.argpartition(dists, n - 1)[:n]
+    else:
+        nearest = np.arange(len(dists))
+    if len(nearest) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([members[indptr[j]:indptr[j + 1]] for j in nearest])
+
+
+class GalleryIndex:
+    """
+    Chooses the gallery images that are compared with a query.
+
+    candidates() returns, per test image, the gallery rows to compute exact distances for
+    (see evaluate(candidate_idx=...)), or None to search the whole gallery.
+    """
+
+    name = "exact"
+
+    def candidates(self, case_representations: np.ndarray) -> Optional[List[np.ndarray]]:
+        return None
+
+
+class ExactGalleryIndex(GalleryIndex):
+    """Brute-force search of every gallery image."""
+
+
+class IVFGalleryIndex(GalleryIndex):
+    """
+    Inverted file index: approximate search over the fused model/tta representation.
+
+    The gallery is clustered with spherical k-means, where the distance between two images is the
+    mean cosine distance over the model/tta slices, as in evaluate(). A query is compared with the
+    n_lists cluster centroids and only the images of the n_probe nearest clusters are searched.
+    Built offline with build_gallery_index.py, see build() and save()/load().
+    """
+
+    name = "ivf"
+
+    def __init__(self, centroids: np.ndarray, members: np.ndarray, indptr: np.ndarray, img_names: np.ndarray,
+                 n_probe: int = 8):
+        self.centroids = centroids
+        self.members = members
+        self.indptr = indptr
+        self.img_names = img_names
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[1]
+
+    @classmethod
+    def build(cls, gallery_representations: np.ndarray, img_names: np.ndarray, n_lists: int = 256,
+              n_iter: int = 20, max_train: int = 50000, n_probe: int = 8, seed: int = 1000) -> "IVFGalleryIndex":
+        """
+        Clusters the (normalized) gallery representations [model/tta, img, dim] into n_lists lists.
+
+        k-means is trained on at most max_train images, then every gallery image is assigned to its
+        nearest centroid.
+        """
+        rng = np.random.default_rng(seed)
+        n_gallery = gallery_representations.shape[1]
+        n_lists = min(n_lists, n_gallery)
+        train = gallery_representations[:, np.sort(rng.choice(n_gallery, min(n_gallery, max_train), replace=False))]
+        n_train = train.shape[1]
+
+        centroids = train[:, rng.choice(n_train, n_lists, replace=False)]
+        for iteration in range(n_iter):
+            assignment = _assign(centroids, train)
+            # sum of the members of each list, one sparse x dense product per slice
+            membership = sp.csr_matrix((np.ones(n_train, dtype=np.float32), (assignment, np.arange(n_train))),
+                                       shape=(n_lists, n_train))
+            sums = np.stack([membership @ representations for representations in train])
+            # restart empty lists from random training images
+            empty, = np.where(np.bincount(assignment, minlength=n_lists) == 0)
+            sums[:, empty] = train[:, rng.choice(n_train, len(empty), replace=False)]
+            norms = np.linalg.norm(sums, axis=2, keepdims=True)
+            centroids = np.ascontiguousarray(sums / np.maximum(norms, np.finfo(np.float32).eps), dtype=np.float32)
+
+        assignment = _assign(centroids, gallery_representations)
+        members = np.argsort(assignment, kind="stable")
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+        return cls(centroids, members, indptr, np.asarray(img_names), n_probe)
+
+    def candidates(self, case_representations: np.ndarray) -> List[np.ndarray]:
+        case_representations = normalize_case_representations(case_representations)
+        list_dists = compute_mean_dists(self.centroids, case_representations)
+        return [np.sort(members_of_nearest(dists, self.n_probe, self.members, self.indptr)) for dists in list_dists]
+
+    def save(self, path: str):
+        np.savez(path, centroids=self.centroids, members=self.members, indptr=self.indptr,
+                 img_names=self.img_names.astype(str))
+
+    @classmethod
+    def load(cls, path: str, img_names: Optional[np.ndarray] = None, n_probe: int = 8) -> "IVFGalleryIndex":
+        """Loads a saved index; if img_names is given, checks that it was built for this gallery (and order)."""
+        with np.load(path) as data:
+            index = cls(data["centroids"], data["members"], data["indptr"], data["img_names"], n_probe)
+        if img_names is not None and not np.array_equal(index.img_names, np.asarray(img_names).astype(str)):
+            raise ValueError(f"Gallery index {path} was built for a different gallery, please rebuild it")
+        print(f"Loaded IVF gallery index: {index.n_lists} lists, n_probe {n_probe}")
+        return index
+
+
+def _assign(centroids: np.ndarray, representations: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    # nearest centroid of each image of [model/tta, img, dim], in chunks to bound the distance matrix
+    return np.concatenate([
+        np.argmin(compute_mean_dists(centroids, np.transpose(representations[:, start:start + chunk_size], (1, 0, 2))),
+                  axis=1)
+        for start in range(0, representations.shape[1], chunk_size)])
+
+
+def measure_recall(gallery_representations: np.ndarray, index: GalleryIndex, case_representations: np.ndarray,
+                   k: int = 10, threshold: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Recall@k of an index against the exact search.
+
+    For every test image, the fraction of its k nearest gallery images (after the distance threshold,
+    as in predict) that are also among the k nearest of the index's candidates. Also reports the mean
+    fraction of the gallery that was searched and the total search times of the queries.
+    """
+    case_representations = normalize_case_representations(case_representations)
+    n_gallery = gallery_representations.shape[1]
+    # only the slices compared with the queries, and one query at a time as in the service
+    gallery_representations = gallery_representations[:case_representations.shape[1]]
+
+    start_time = time.time()
+    exact_ranked = []
+    for i in range(len(case_representations)):
+        dists = compute_mean_dists(gallery_representations, case_representations[i:i + 1])[0]
+        exact_ranked.append(rank_top_k(dists, k, threshold)[:k])
+    exact_time = time.time() - start_time
+
+    start_time = time.time()
+    candidates = index.candidates(case_representations)
+    approx_ranked = []
+    for i in range(len(case_representations)):
+        rows = np.arange(n_gallery) if candidates is None else candidates[i]
+        dists = compute_mean_dists(gallery_representations[:, rows], case_representations[i:i + 1])[0]
+        approx_ranked.append(rows[rank_top_k(dists, k, threshold)[:k]])
+    index_time = time.time() - start_time
+
+    recalls = [len(np.intersect1d(exact, approx)) / len(exact)
+               for exact, approx in zip(exact_ranked, approx_ranked) if len(exact) > 0]
+    searched = 1.0 if candidates is None else float(np.mean([len(rows) for rows in candidates])) / n_gallery
+    return {"k": k,
+            "recall": float(np.mean(recalls)) if recalls else None,
+            "searched_fraction": searched,
+            "exact_time": exact_time,
+            "index_time": index_time}
@@ -0,0 +1,81 @@
+import hashlib
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+GALLERY_STORE_VERSION = 1
+LABEL_KEYS = ('synds', 'genes', 'genes_indptr', 'subjects')
+
+
+def index_path(matrix_path: str) -> str:
+    """Path of the sidecar index (image ids and labels) of a gallery matrix: <name>_index.npz."""
+    return os.path.splitext(matrix_path)[0] + '_index.npz'
+
+
+def metadata_fingerprint(metadata_bytes: bytes) -> str:
+    """sha256 of the metadata pickle the gallery labels were built from."""
+    return hashlib.sha256(metadata_bytes).hexdigest()
+
+
+def save_gallery_matrix(matrix_path: str, gallery_representations: np.ndarray, img_names: np.ndarray,
+                        gallery_labels: Dict[str, np.ndarray], fingerprint: str = ''):
+    """
+    Writes the gallery as a flat float32 .npy matrix and a sidecar .npz index.
+
+    The matrix is stored as the service searches it (see build_gallery_representations): L2-normalized
+    [model/tta, img, dim], so that load_gallery_matrix() only maps it. The index holds the image id of
+    every row, the label arrays of build_gallery_labels and the fingerprint of the metadata pickle.
+    Both files are written to a temporary file first and renamed, so a running service never maps a
+    half-written file.
+    """
+    representations = np.ascontiguousarray(gallery_representations, dtype=np.float32)
+    if representations.ndim != 3 or representations.shape[1] != len(img_names):
+        raise ValueError(f"Gallery matrix of shape {representations.shape} does not match {len(img_names)} images")
+
+    tmp_path = matrix_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, representations)
+    os.replace(tmp_path, matrix_path)
+
+    sidecar_path = index_path(matrix_path)
+    tmp_path = sidecar_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, version=GALLERY_STORE_VERSION, img_names=np.asarray(img_names).astype(str),
+                 fingerprint=fingerprint, **{key: gallery_labels[key] for key in LABEL_KEYS})
+    os.replace(tmp_path, sidecar_path)
+
+
+def load_gallery_matrix(matrix_path: str, fingerprint: Optional[str] = None,
+                        mmap: bool = True) -> Tuple[pd.DataFrame, np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Opens a gallery written by save_gallery_matrix().
+
+    The matrix is memory-mapped read-only, so loading is instant, pages are only read when they are
+    searched and the page cache is shared by all processes mapping the same file.
+
+    Args:
+        fingerprint: metadata_fingerprint() of the metadata pickle the service uses; if given, the
+            gallery must have been converted with the same metadata.
+    Returns:
+        (gallery_df, gallery_representations, gallery_labels): gallery_df only has the img_name column.
+    """
+    # label arrays of mixed-type ids are saved as object arrays; the index is as trusted as the metadata pickle
+    with np.load(index_path(matrix_path), allow_pickle=True) as index:
+        if int(index['version']) != GALLERY_STORE_VERSION:
+            raise ValueError(f"Gallery matrix {matrix_path} has version {int(index['version'])}, "
+                             f"expected {GALLERY_STORE_VERSION}, please convert it again")
+        if fingerprint is not None and str(index['fingerprint']) != fingerprint:
+            raise ValueError(f"Gallery matrix {matrix_path} was converted with a different metadata file, "
+                             f"please convert it again")
+        img_names = index['img_names']
+        gallery_labels = {key: index[key] for key in LABEL_KEYS}
+
+    gallery_representations = np.load(matrix_path, mmap_mode='r' if mmap else None)
+    if gallery_representations.ndim != 3 or gallery_representations.shape[1] != len(img_names):
+        raise ValueError(f"Gallery matrix {matrix_path} of shape {gallery_representations.shape} "
+                         f"does not match its index of {len(img_names)} images")
+    gallery_df = pd.DataFrame({'img_name': img_names.astype(object)})
+    print(f"Load gallery matrix: {len(img_names)} images, {gallery_representations.shape[0]} slices")
+    return gallery_df, gallery_representations, gallery_labels
@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class InferencePoolFull(Exception):
+    """Raised when all workers are busy and the waiting queue is full."""
+
+
+class InferencePool:
+    """
+    Bounded thread pool that runs the blocking model/network work off the event loop.
+
+    At most max_workers calls run at the same time and at most max_queue further calls wait
+    for a free worker. Calls beyond that are rejected with InferencePoolFull right away, so the
+    event loop (and /api/status) stays responsive under load.
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 8):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        # only touched from the event loop, so no lock is needed
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of running and waiting calls."""
+        return self._pending
+
+    @property
+    def full(self) -> bool:
+        """Whether run() would be rejected right now."""
+        return self._pending >= self.max_workers + self.max_queue
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs fn(*args, **kwargs) in a worker thread, or raises InferencePoolFull."""
+        if self.full:
+            raise InferencePoolFull()
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
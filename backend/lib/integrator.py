@@ -1,4 +1,5 @@
-from typing import Dict, Any, List, Tuple
+import heapq
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 def _parse_composite_omim(omim_value: Any) -> Tuple[int | None, str | None]:
     """
@@ -6,95 +7,154 @@ def _parse_composite_omim(omim_value: Any) -> Tuple[int | None, str | None]:
     """
     if not omim_value:
         return None, None
-    
-    parts = [p.strip() for p in str(omim_value).split(',')]
-    numeric_id_str = next((p for p in parts if not p.startswith('PS')), None)
-    ps_id = next((p for p in parts if p.startswith('PS')), None)
-    
+
+    numeric_id_str, ps_id = None, None
+    for part in str(omim_value).split(','):
+        part = part.strip()
+        if part.startswith('PS'):
+            if ps_id is None:
+                ps_id = part
+        elif numeric_id_str is None:
+            numeric_id_str = part
+
     numeric_id = int(numeric_id_str) if numeric_id_str and numeric_id_str.isdigit() else None
-    
+
     return numeric_id, ps_id
 
-def _add_gm_rank_and_score(item_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not item_list: return []
-    for i, item in enumerate(item_list): item['gm_rank'] = i + 1
+_UNRANKED = float('inf')
+
+def _gm_score_range(item_list: List[Dict[str, Any]]) -> Optional[Tuple[float, float]]:
+    """(min, range) of the distances for the min-max scaled GestaltMatcher scores, None if distances are missing."""
     try:
         distances = [item['distance'] for item in item_list]
         min_dist, max_dist = min(distances), max(distances)
-        dist_range = max_dist - min_dist
-        if dist_range == 0:
-            for item in item_list: item['score'] = 1.0
-        else:
-            for item in item_list: item['score'] = 1.0 - (item['distance'] - min_dist) / dist_range
-    except (KeyError, ValueError):
-        for item in item_list: item['score'] = None
-    return item_list
+    except (KeyError, TypeError, ValueError):
+        return None
+    return min_dist, max_dist - min_dist
 
-def _add_meta_rank_to_list(item_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def _rank_list(item_list: List[Dict[str, Any]],
+               matches: Optional[List[Optional[Dict[str, Any]]]] = None,
+               extra_fields: Optional[List[Dict[str, Any]]] = None,
+               top_n: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    GestaltMatcher rank and score, PubCaseFinder join and meta-ranking of one result list.
+
+    matches holds the PubCaseFinder entry of every item (None if unmatched). The sort keys are
+    collected in one pass; the item dicts are only updated for the returned top_n.
+    """
     if not item_list: return []
-    for item in item_list:
-        gm_rank = item.get('gm_rank')
-        pcf_rank = item.get('pubcasefinder_rank')
-        item['mean_rank'] = (gm_rank + pcf_rank) / 2 if isinstance(gm_rank, (int, float)) and isinstance(pcf_rank, (int, float)) else None
-    item_list.sort(key=lambda x: (x.get('mean_rank') is None, x.get('mean_rank')))
-    for i, item in enumerate(item_list): item['meta_rank'] = i + 1
-    return item_list
-
-def integrate_json(raw_results: Dict[str, Any]) -> Dict[str, Any]:
+    n = len(item_list)
+    score_range = _gm_score_range(item_list)
+
+    # gm_rank + pcf_rank orders like the mean rank; items without a numeric PubCaseFinder rank go last,
+    # and the stable sort keeps ties in the GestaltMatcher order
+    if matches is not None:
+        ranks = [entry['pubcasefinder_rank'] if entry is not None else None for entry in matches]
+        sort_keys = [gm_rank + rank if isinstance(rank, (int, float)) else _UNRANKED
+                     for gm_rank, rank in enumerate(ranks, start=1)]
+        if top_n is not None and top_n < n:
+            order = heapq.nsmallest(top_n, range(n), key=sort_keys.__getitem__)
+        else:
+            order = sorted(range(n), key=sort_keys.__getitem__)
+    else:
+        order = range(n)
+    if top_n is not None:
+        order = order[:top_n]
+
+    ranked_list = []
+    append = ranked_list.append
+    min_dist, dist_range = score_range if score_range is not None else (None, None)
+    for meta_rank, i in enumerate(order, start=1):
+        item = item_list[i]
+        item['gm_rank'] = i + 1
+        if score_range is None:
+            item['score'] = None
+        elif dist_range == 0:
+            item['score'] = 1.0
+        else:
+            item['score'] = 1.0 - (item['distance'] - min_dist) / dist_range
+        if extra_fields is not None:
+            item.update(extra_fields[i])
+        entry = matches[i] if matches is not None else None
+        if entry is None:
+            item['mean_rank'] = None
+        else:
+            item['pubcasefinder_rank'] = entry['pubcasefinder_rank']
+            item['pubcasefinder_score'] = entry['pubcasefinder_score']
+            item['mean_rank'] = sort_keys[i] / 2 if sort_keys[i] is not _UNRANKED else None
+        item['meta_rank'] = meta_rank
+        append(item)
+    return ranked_list
+
+def integrate_json(raw_results: Dict[str, Any],
+                   top_n: Optional[Union[int, Dict[str, int]]] = None) -> Dict[str, Any]:
+    """
+    Ranks, scores and joins the GestaltMatcher lists with PubCaseFinder.
+
+    The lists of raw_results are replaced by the ranked lists, whose items are updated in place.
+    top_n keeps only the first entries of every list, or of the lists in a {list key: n} dict;
+    the items of the dropped entries are left untouched.
+    """
     print("--- Starting results integration ---")
 
-    # Step 1: Pre-process raw GestaltMatcher lists
-    for key in ['suggested_syndromes_list', 'suggested_genes_list', 'suggested_patients_list']:
-        if key in raw_results:
-            raw_results[key] = _add_gm_rank_and_score(raw_results[key])
-    
+    def list_top_n(key):
+        return top_n.get(key) if isinstance(top_n, dict) else top_n
+
+    # Step 1: Parse the composite OMIM IDs of the patients, used to match them to PubCaseFinder
     patient_key = 'suggested_patients_list'
+    patient_fields = None
     if patient_key in raw_results:
+        # patients share few distinct OMIM IDs, so each is parsed once
+        parsed = {}
+        patient_fields = []
         for patient in raw_results[patient_key]:
-            numeric_omim, ps_id = _parse_composite_omim(patient.get('omim_id'))
-            patient['numeric_omim_id'] = numeric_omim
-            patient['phenotypic_series_id'] = ps_id
-            patient['omim_id_for_match'] = numeric_omim
+            omim_value = patient.get('omim_id')
+            fields = parsed.get(omim_value)
+            if fields is None:
+                numeric_omim, ps_id = _parse_composite_omim(omim_value)
+                fields = parsed[omim_value] = {'numeric_omim_id': numeric_omim,
+                                               'phenotypic_series_id': ps_id,
+                                               'omim_id_for_match': numeric_omim}
+            patient_fields.append(fields)
 
-    # Step 2: Enrich with PubCaseFinder data
+    # Step 2: Index the PubCaseFinder data by OMIM ID and gene symbol
     pcf_data = raw_results.get('pubcasefinder')
-    
+    omim_lookup, gene_lookup = None, None
+
     if pcf_data and isinstance(pcf_data, dict) and 'ranked_list' in pcf_data:
         pcf_results_list = pcf_data.get('ranked_list', [])
-        
-        pcf_by_omim = {}
-        pcf_by_gene = {}
+
+        omim_lookup, gene_lookup = {}, {}
         for item in pcf_results_list:
-            if item.get('id') and item['id'].startswith('OMIM:'):
-                omim_id_str = item['id'].replace('OMIM:', '')
-                pcf_by_omim[omim_id_str] = {'pubcasefinder_rank': item.get('rank'), 'pubcasefinder_score': item.get('score')}
-            if item.get('hgnc_gene_symbol') and isinstance(item.get('hgnc_gene_symbol'), list):
-                for gene_symbol in item['hgnc_gene_symbol']:
-                    pcf_by_gene[gene_symbol] = {'pubcasefinder_rank': item.get('rank'), 'pubcasefinder_score': item.get('score')}
-        
-        if 'suggested_syndromes_list' in raw_results:
-            for item in raw_results['suggested_syndromes_list']:
-                omim_id = item.get('omim_id')
-                if omim_id and str(omim_id) in pcf_by_omim:
-                    item.update(pcf_by_omim[str(omim_id)])
-
-        if patient_key in raw_results:
-            for item in raw_results[patient_key]:
-                omim_id = item.get('omim_id_for_match')
-                if omim_id and str(omim_id) in pcf_by_omim:
-                    item.update(pcf_by_omim[str(omim_id)])
-
-        if 'suggested_genes_list' in raw_results:
-            for item in raw_results['suggested_genes_list']:
-                gene_name = item.get('gene_name')
-                if gene_name and gene_name in pcf_by_gene:
-                    item.update(pcf_by_gene[gene_name])
-
-    # Step 3: Apply meta-ranking
-    for key in ['suggested_syndromes_list', 'suggested_genes_list', 'suggested_patients_list']:
-         if key in raw_results:
-            raw_results[key] = _add_meta_rank_to_list(raw_results[key])
+            entry = {'pubcasefinder_rank': item.get('rank'), 'pubcasefinder_score': item.get('score')}
+            pcf_id = item.get('id')
+            if pcf_id and pcf_id.startswith('OMIM:'):
+                omim_lookup[pcf_id.replace('OMIM:', '')] = entry
+            gene_symbols = item.get('hgnc_gene_symbol')
+            if gene_symbols and isinstance(gene_symbols, list):
+                for gene_symbol in gene_symbols:
+                    gene_lookup[gene_symbol] = entry
+
+    # Step 3: Rank, score, join and meta-rank each list
+    if 'suggested_syndromes_list' in raw_results:
+        items = raw_results['suggested_syndromes_list']
+        matches = [omim_lookup.get(str(omim_id)) if (omim_id := item.get('omim_id')) else None
+                   for item in items] if omim_lookup else None
+        raw_results['suggested_syndromes_list'] = _rank_list(
+            items, matches, top_n=list_top_n('suggested_syndromes_list'))
+
+    if patient_key in raw_results:
+        matches = [omim_lookup.get(str(omim_id)) if (omim_id := fields['omim_id_for_match']) else None
+                   for fields in patient_fields] if omim_lookup else None
+        raw_results[patient_key] = _rank_list(
+            raw_results[patient_key], matches, extra_fields=patient_fields, top_n=list_top_n(patient_key))
+
+    if 'suggested_genes_list' in raw_results:
+        items = raw_results['suggested_genes_list']
+        matches = [gene_lookup.get(gene_name) if (gene_name := item.get('gene_name')) else None
+                   for item in items] if gene_lookup else None
+        raw_results['suggested_genes_list'] = _rank_list(
+            items, matches, top_n=list_top_n('suggested_genes_list'))
 
     print("--- Integration and meta-ranking complete ---")
     return raw_results
-
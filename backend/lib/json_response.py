@@ -0,0 +1,114 @@
+import gzip
+from typing import Any, Optional
+
+import numpy as np
+import orjson
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# bodies of at least this many bytes are compressed in a worker thread by FastJSONResponse.create
+THREAD_COMPRESS_MIN_BYTES = 64 * 1024
+
+# OPT_SERIALIZE_NUMPY covers ndarrays and NumPy scalars (np.str_ is a str subclass, which orjson handles anyway)
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj: Any) -> Any:
+    # types orjson does not serialize itself
+    if isinstance(obj, bytes):
+        return obj.decode("utf8")
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    """Serializes a result with orjson, including NumPy arrays and scalars."""
+    return orjson.dumps(content, default=_default, option=ORJSON_OPTIONS)
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred compression the client accepts: 'br' (if Brotli is installed), 'gzip' or None."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip())
+    if BROTLI_AVAILABLE and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """Compresses a body with the encoding negotiate_encoding chose."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _prepare(content: Any, request: Optional[Request], compress_min_bytes: Optional[int]):
+    # serialized body, the compression to apply (None if none) and the response headers
+    headers = {}
+    body = dumps(content)
+    encoding = None
+    if request is not None and compress_min_bytes is not None:
+        headers["Vary"] = "Accept-Encoding"
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding is not None and len(body) >= compress_min_bytes:
+            headers["Content-Encoding"] = encoding
+        else:
+            encoding = None
+    return body, encoding, headers
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response serialized with orjson, skipping FastAPI's jsonable_encoder.
+
+    The body is compressed with Brotli or gzip when a request is given whose Accept-Encoding allows
+    it and the body is at least compress_min_bytes long (None disables compression). In async code,
+    use create(), which compresses large bodies off the event loop.
+    """
+
+    media_type = "application/json"
+
+    def __init__(self, content: Any, request: Optional[Request] = None,
+                 compress_min_bytes: Optional[int] = 1024, status_code: int = 200):
+        body, encoding, headers = _prepare(content, request, compress_min_bytes)
+        if encoding is not None:
+            body = compress(body, encoding)
+        super().__init__(body, status_code=status_code, headers=headers)
+
+    @classmethod
+    async def create(cls, content: Any, request: Optional[Request] = None,
+                     compress_min_bytes: Optional[int] = 1024, status_code: int = 200) -> Response:
+        """
+        Same response as the constructor, but bodies of at least THREAD_COMPRESS_MIN_BYTES are
+        compressed in a worker thread, so a large result does not stall the other connections.
+        """
+        body, encoding, headers = _prepare(content, request, compress_min_bytes)
+        if encoding is not None:
+            if len(body) >= THREAD_COMPRESS_MIN_BYTES:
+                body = await run_in_threadpool(compress, body, encoding)
+            else:
+                body = compress(body, encoding)
+        return Response(body, status_code=status_code, headers=headers, media_type=cls.media_type)
+
+    def render(self, content: Any) -> bytes:
+        # the body is serialized (and compressed) in __init__ already
+        return content
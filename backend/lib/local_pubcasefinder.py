@@ -0,0 +1,147 @@
+import csv
+import math
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def _read_hpo_ontology(obo_path: str):
+    """
+    Parses hp.obo into term names, is_a parents and alternative IDs.
+
+    Returns:
+        (names, parents, alt_ids) with names[hpo_id] -> str, parents[hpo_id] -> list of HPO IDs
+        and alt_ids[alt_id] -> primary HPO ID.
+    """
+    names, parents, alt_ids = {}, defaultdict(list), {}
+    term = None
+    with open(obo_path, "r", encoding="utf8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                term = {} if line == "[Term]" else None
+                continue
+            if term is None or ":" not in line:
+                continue
+            tag, value = line.split(":", 1)
+            value = value.split("!", 1)[0].strip()
+            if tag == "id":
+                term["id"] = value
+            elif "id" not in term:
+                continue
+            elif tag == "name":
+                names[term["id"]] = value
+            elif tag == "is_a":
+                parents[term["id"]].append(value)
+            elif tag == "alt_id":
+                alt_ids[value] = term["id"]
+    return names, parents, alt_ids
+
+
+def _read_disease_annotations(hpoa_path: str) -> Dict[str, Set[str]]:
+    """Reads the OMIM phenotype annotations (aspect P, without NOT) of phenotype.hpoa."""
+    annotations = defaultdict(set)
+    with open(hpoa_path, "r", encoding="utf8") as f:
+        rows = csv.reader((line for line in f if not line.startswith("#")), delimiter="\t")
+        header = next(rows)
+        col = {name: i for i, name in enumerate(header)}
+        for row in rows:
+            if not row[col["database_id"]].startswith("OMIM:"):
+                continue
+            if row[col["qualifier"]] == "NOT" or row[col["aspect"]] != "P":
+                continue
+            annotations[row[col["database_id"]]].add(row[col["hpo_id"]])
+    return annotations
+
+
+def _read_disease_genes(genes_path: str) -> Dict[str, List[str]]:
+    """Reads the gene symbols per disease of genes_to_disease.txt."""
+    disease_genes = defaultdict(list)
+    with open(genes_path, "r", encoding="utf8") as f:
+        rows = csv.reader((line for line in f if not line.startswith("#")), delimiter="\t")
+        header = next(rows)
+        col = {name: i for i, name in enumerate(header)}
+        for row in rows:
+            genes = disease_genes[row[col["disease_id"]]]
+            if row[col["gene_symbol"]] not in genes:
+                genes.append(row[col["gene_symbol"]])
+    return disease_genes
+
+
+class LocalPhenotypeIndex:
+    """
+    Offline replacement for the PubCaseFinder ranking, built from a local HPO annotation snapshot.
+
+    Disease annotations (phenotype.hpoa) are propagated to all ancestor terms (hp.obo) and
+    stored as a sparse disease x term matrix. A query is scored against every disease with one
+    sparse mat-vec: the information content (IC = -log of the fraction of diseases annotated
+    with a term) of the query's terms and ancestors shared with the disease, divided by the IC
+    of all of the query's terms and ancestors. Without hp.obo only the exact terms are compared.
+    """
+
+    def __init__(self, hpoa_path: str, genes_path: Optional[str] = None, obo_path: Optional[str] = None):
+        if obo_path:
+            self.names, self._parents, self._alt_ids = _read_hpo_ontology(obo_path)
+        else:
+            self.names, self._parents, self._alt_ids = {}, {}, {}
+        self._ancestors = {}
+
+        annotations = _read_disease_annotations(hpoa_path)
+        self.disease_genes = _read_disease_genes(genes_path) if genes_path else {}
+        self.disease_ids = sorted(annotations.keys())
+
+        # sparse, ancestor-propagated disease x term matrix
+        self.term_index = {}
+        rows, cols = [], []
+        for row, disease_id in enumerate(self.disease_ids):
+            for hpo_id in self._propagate(annotations[disease_id]):
+                cols.append(self.term_index.setdefault(hpo_id, len(self.term_index)))
+                rows.append(row)
+        self.matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                    shape=(len(self.disease_ids), len(self.term_index)))
+
+        term_freq = np.asarray(self.matrix.sum(axis=0)).ravel()
+        self.ic = -np.log(term_freq / max(len(self.disease_ids), 1)).astype(np.float32)
+        print(f"Loaded local HPO annotations: {len(self.disease_ids)} diseases, {len(self.term_index)} terms")
+
+    def _propagate(self, hpo_ids) -> Set[str]:
+        # the terms with all of their is_a ancestors
+        terms = set()
+        for hpo_id in hpo_ids:
+            hpo_id = self._alt_ids.get(hpo_id, hpo_id)
+            if hpo_id not in self._ancestors:
+                ancestors = {hpo_id}
+                stack = [hpo_id]
+                while stack:
+                    for parent in self._parents.get(stack.pop(), []):
+                        if parent not in ancestors:
+                            ancestors.add(parent)
+                            stack.append(parent)
+                self._ancestors[hpo_id] = ancestors
+            terms |= self._ancestors[hpo_id]
+        return terms
+
+    def rank(self, hpo_ids: List[str]) -> List[Dict[str, Any]]:
+        """Diseases ranked by similarity to the HPO IDs, in the format of pcf_get_ranked_list."""
+        cols = [self.term_index[hpo_id] for hpo_id in self._propagate(hpo_ids) if hpo_id in self.term_index]
+        query = np.zeros(len(self.term_index), dtype=np.float32)
+        query[cols] = self.ic[cols]
+        query_ic = query.sum()
+        if query_ic <= 0:
+            return []
+
+        scores = self.matrix.dot(query) / query_ic
+        hits, = np.nonzero(scores > 0)
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [{"id": self.disease_ids[i],
+                 "rank": rank,
+                 "score": round(float(scores[i]), 4),
+                 "hgnc_gene_symbol": self.disease_genes.get(self.disease_ids[i], [])}
+                for rank, i in enumerate(hits, start=1)]
+
+    def hpo_names(self, hpo_ids: List[str]) -> Dict[str, Any]:
+        """HPO term names, in the format of pcf_get_hpo_data_by_hpo_id (English names only)."""
+        return {hpo_id: {"name_en": self.names[self._alt_ids.get(hpo_id, hpo_id)]}
+                for hpo_id in hpo_ids if self._alt_ids.get(hpo_id, hpo_id) in self.names}
@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple
+
+import numpy as np
+
+from lib.encode import Encoding, encode_batch
+
+
+class MicroBatcher:
+    """
+    Encodes aligned faces of concurrent requests together.
+
+    Request threads call encode() and block until their embeddings are ready. A background
+    thread takes the faces already queued, up to max_batch_size, runs them through each model
+    as one batch (encode_batch) and hands every request its own Encoding. A lone face is encoded
+    right away; only when other faces are queued with it does the thread wait up to max_wait_ms
+    for more to fill the batch.
+    """
+
+    def __init__(self, models, device, max_batch_size: int = 8, max_wait_ms: float = 5):
+        self.models = models
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, img: np.ndarray, flip_flag: bool = True, gray_flag: bool = True) -> Encoding:
+        """Same as lib.encode.encode, but shares the forward passes with concurrent requests."""
+        future = Future()
+        self._queue.put((img, flip_flag, gray_flag, future))
+        return future.result()
+
+    def close(self):
+        """Stops the background thread after the queued faces have been encoded."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            # take the faces queued meanwhile; a lone face is encoded without waiting
+            batch = [item]
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            # under concurrent load, collect more faces until the batch is full or the first one waited max_wait
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) > 1 and len(batch) < self.max_batch_size and not stopped:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            self._encode(batch)
+
+    def _encode(self, batch: List[Tuple]):
+        # faces of one batch can only share a forward pass if they use the same TTA variants
+        groups = {}
+        for img, flip_flag, gray_flag, future in batch:
+            groups.setdefault((flip_flag, gray_flag), []).append((img, future))
+
+        for (flip_flag, gray_flag), items in groups.items():
+            try:
+                encodings = encode_batch(self.models, self.device, [img for img, _ in items], flip_flag, gray_flag)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), encoding in zip(items, encodings):
+                future.set_result(encoding)
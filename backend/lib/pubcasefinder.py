@@ -1,10 +1,161 @@
-import requests
+import httpx
 import json
-from typing import List, Dict, Any
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import List, Dict, Any, Optional, Tuple
+
+from lib.ttl_cache import TTLCache
+from lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+try:
+    import h2  # noqa: F401 -- httpx only speaks HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # Define API endpoints
-PCF_RANKED_LIST_API_URL = "https://pubcasefinder.dbcls.jp/api/pcf_get_ranked_list"
-PCF_HPO_DATA_API_URL = "https://pubcasefinder.dbcls.jp/api/pcf_get_hpo_data_by_hpo_id"
+PCF_BASE_URL = "https://pubcasefinder.dbcls.jp"
+PCF_RANKED_LIST_API_PATH = "/api/pcf_get_ranked_list"
+PCF_HPO_DATA_API_PATH = "/api/pcf_get_hpo_data_by_hpo_id"
+
+# Background threads for the API requests, so they run in parallel with each other and the face analysis
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pubcasefinder")
+
+class ClientClosedError(RuntimeError):
+    """Raised for a request after close_client, e.g. by a query still running during the shutdown."""
+
+# Pooled keep-alive client shared by all requests, see open_client; closed by close_client on shutdown
+_client: Optional[httpx.Client] = None
+_client_closed = False
+
+# Responses keyed by the normalized HPO ID set, and HPO names per term, see configure_cache
+_ranked_list_cache = TTLCache()
+_hpo_names_cache = TTLCache()
+_hpo_names_per_term = True
+
+# Offline ranking used instead of the API when set, see use_local_index
+_local_index = None
+
+# Skips the API while it keeps failing, see configure_circuit_breaker
+_breaker = CircuitBreaker()
+
+def open_client(base_url: str = PCF_BASE_URL,
+                connect_timeout: float = 5.0,
+                read_timeout: float = 30.0,
+                max_connections: int = 16,
+                http2: bool = True,
+                transport: Optional[httpx.BaseTransport] = None) -> httpx.Client:
+    """
+    Creates the HTTP client used for all PubCaseFinder requests.
+
+    The client keeps its connections to the API alive, so requests skip the TCP and TLS
+    handshakes; it is thread-safe and shared by the background threads. HTTP/2 is only
+    used if requested and the h2 package is installed. transport replaces the network
+    transport, e.g. with an httpx.MockTransport in tests. Call close_client on shutdown.
+    """
+    global _client, _client_closed
+    close_client()
+    _client = httpx.Client(
+        base_url=base_url,
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        http2=http2 and HTTP2_AVAILABLE,
+        transport=transport,
+    )
+    _client_closed = False
+    return _client
+
+def close_client():
+    """Closes the pooled connections of the client created by open_client; later requests raise until it is reopened."""
+    global _client, _client_closed
+    if _client is not None:
+        _client.close()
+        _client = None
+    _client_closed = True
+
+def _get_client() -> httpx.Client:
+    # scripts using this module without the service lifespan get a client with the defaults,
+    # but a request after close_client (a query outliving the shutdown) is an error
+    if _client is None:
+        if _client_closed:
+            raise ClientClosedError("The PubCaseFinder client was closed, call open_client first")
+        open_client()
+    return _client
+
+def configure_cache(max_size: int = 1024,
+                    ttl: float = 86400,
+                    disk_dir: Optional[str] = None,
+                    per_term: bool = True):
+    """
+    Sets up the caches of the ranked lists and HPO names.
+
+    Ranked lists are cached per normalized HPO ID set (see normalize_hpo_ids), so reordered or
+    repeated queries are answered without a request. With per_term, HPO names are cached per
+    term and only the terms missing from the cache are fetched. Both caches hold up to
+    max_size entries for ttl seconds; with disk_dir they are also kept on disk.
+    """
+    global _ranked_list_cache, _hpo_names_cache, _hpo_names_per_term
+    _ranked_list_cache = TTLCache(max_size, ttl, os.path.join(disk_dir, 'ranked_list') if disk_dir else None)
+    _hpo_names_cache = TTLCache(max_size, ttl, os.path.join(disk_dir, 'hpo_names') if disk_dir else None)
+    _hpo_names_per_term = per_term
+
+def use_local_index(index):
+    """
+    Answers all queries from a LocalPhenotypeIndex instead of the PubCaseFinder API.
+
+    The results have the same format, so integrate_json works unchanged. Pass None to
+    go back to the API.
+    """
+    global _local_index
+    _local_index = index
+
+def configure_circuit_breaker(failure_threshold: int = 3, cooldown: float = 60):
+    """
+    Sets up the circuit breaker around the API requests.
+
+    After failure_threshold consecutive failed or timed out requests, the API is not called
+    for cooldown seconds and queries return an error right away (cached responses are still
+    used), so predictions fall back to the GestaltMatcher-only result without waiting.
+    """
+    global _breaker
+    _breaker = CircuitBreaker(failure_threshold, cooldown)
+
+def breaker_stats() -> Dict[str, Any]:
+    """State and trip counters of the circuit breaker."""
+    return _breaker.stats()
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """Hit/miss counters of the ranked list and HPO name caches."""
+    return {"ranked_list": _ranked_list_cache.stats(), "hpo_names": _hpo_names_cache.stats()}
+
+def normalize_hpo_ids(hpo_ids: List[str]) -> List[str]:
+    """Sorted, deduplicated HPO IDs, so the same term set always gives the same query."""
+    return sorted(set(hpo_id.strip() for hpo_id in hpo_ids))
+
+def _get_json(path: str, params: Dict[str, str]) -> Any:
+    """
+    GET request to the API through the circuit breaker, which records exactly one outcome per request.
+
+    Transport errors, timeouts, 5xx responses and invalid JSON are failures of the API; a 4xx
+    response rejects only this request (e.g. malformed HPO IDs) and is not held against the API.
+    """
+    client = _get_client()
+    if not _breaker.allow_request():
+        raise CircuitOpenError()
+    try:
+        response = client.get(path, params=params)
+        if not response.is_client_error:
+            response.raise_for_status()
+            data = response.json()
+    except Exception:
+        _breaker.record_failure()
+        raise
+    if response.is_client_error:
+        _breaker.record_client_error()
+        response.raise_for_status()
+    _breaker.record_success()
+    return data
 
 def _fetch_ranked_list(hpo_ids: List[str]) -> List[Dict[str, Any]]:
     """Fetches the ranked list of diseases from PubCaseFinder."""
@@ -13,37 +164,92 @@ def _fetch_ranked_list(hpo_ids: List[str]) -> List[Dict[str, Any]]:
         'format': 'json',
         'hpo_id': ','.join(hpo_ids)
     }
-    response = requests.get(PCF_RANKED_LIST_API_URL, params=params, timeout=30)
-    response.raise_for_status()
-    return response.json()
+    return _get_json(PCF_RANKED_LIST_API_PATH, params)
 
 def _fetch_hpo_names(hpo_ids: List[str]) -> Dict[str, Any]:
     """Fetches HPO term names from PubCaseFinder."""
     params = {'hpo_id': ','.join(hpo_ids)}
-    response = requests.get(PCF_HPO_DATA_API_URL, params=params, timeout=30)
-    response.raise_for_status()
-    return response.json()
+    return _get_json(PCF_HPO_DATA_API_PATH, params)
 
-def query_pubcasefinder(hpo_ids: List[str]) -> Dict[str, Any]:
+def _get_ranked_list(hpo_ids: List[str]) -> List[Dict[str, Any]]:
+    """Ranked list for normalized HPO IDs, from the cache if possible."""
+    if _local_index is not None:
+        return _local_index.rank(hpo_ids)
+
+    key = ','.join(hpo_ids)
+    ranked_list = _ranked_list_cache.get(key)
+    if ranked_list is None:
+        ranked_list = _fetch_ranked_list(hpo_ids)
+        _ranked_list_cache.put(key, ranked_list)
+    return ranked_list
+
+def _get_hpo_names(hpo_ids: List[str]) -> Dict[str, Any]:
+    """HPO names for normalized HPO IDs, only fetching the ones that are not cached yet."""
+    if _local_index is not None:
+        return _local_index.hpo_names(hpo_ids)
+
+    if not _hpo_names_per_term:
+        key = ','.join(hpo_ids)
+        hpo_names = _hpo_names_cache.get(key)
+        if hpo_names is None:
+            hpo_names = _fetch_hpo_names(hpo_ids)
+            _hpo_names_cache.put(key, hpo_names)
+        return hpo_names
+
+    hpo_names = {}
+    missing_hpo_ids = []
+    for hpo_id in hpo_ids:
+        hpo_data = _hpo_names_cache.get(hpo_id)
+        if hpo_data is None:
+            missing_hpo_ids.append(hpo_id)
+        else:
+            hpo_names[hpo_id] = hpo_data
+
+    if missing_hpo_ids:
+        fetched_hpo_names = _fetch_hpo_names(missing_hpo_ids)
+        if not isinstance(fetched_hpo_names, dict):
+            # unexpected format, can't be split into terms
+            return fetched_hpo_names
+        for hpo_id, hpo_data in fetched_hpo_names.items():
+            _hpo_names_cache.put(hpo_id, hpo_data)
+        hpo_names.update(fetched_hpo_names)
+    return hpo_names
+
+def start_pubcasefinder_query(hpo_ids: List[str]) -> Optional[Tuple[Future, Future]]:
     """
-    Queries PubCaseFinder for both ranked disease list and HPO term names.
+    Starts the ranked list and HPO name requests in parallel in the background.
+
+    This lets the network round trips overlap with the face analysis; the returned
+    futures are joined with collect_pubcasefinder_query.
+    """
+    if not hpo_ids:
+        return None
+
+    print(f"Querying PubCaseFinder with HPO IDs: {hpo_ids}")
+    hpo_ids = normalize_hpo_ids(hpo_ids)
+    return _executor.submit(_get_ranked_list, hpo_ids), _executor.submit(_get_hpo_names, hpo_ids)
+
+def collect_pubcasefinder_query(query: Optional[Tuple[Future, Future]],
+                                deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Waits for a query started by start_pubcasefinder_query.
 
     Args:
-        hpo_ids: A list of HPO term IDs.
+        query: The futures returned by start_pubcasefinder_query.
+        deadline: time.monotonic() after which to stop waiting, so a slow API
+            can't push the request past its latency budget.
 
     Returns:
         A dictionary containing both the ranked list and HPO name data,
         or an error message if any query fails.
     """
-    if not hpo_ids:
+    if query is None:
         return {}
 
-    print(f"Querying PubCaseFinder with HPO IDs: {hpo_ids}")
-
+    ranked_list_future, hpo_names_future = query
     try:
-        # Fetch both sets of data from the API
-        ranked_list = _fetch_ranked_list(hpo_ids)
-        hpo_names = _fetch_hpo_names(hpo_ids)
+        ranked_list = ranked_list_future.result(timeout=_remaining(deadline))
+        hpo_names = hpo_names_future.result(timeout=_remaining(deadline))
 
         # --- Debugging Output ---
         print("--- PubCaseFinder Ranked List Response (Truncated) ---")
@@ -56,6 +262,35 @@ def query_pubcasefinder(hpo_ids: List[str]) -> Dict[str, Any]:
             "hpo_names": hpo_names
         }
 
-    except requests.exceptions.RequestException as e:
+    except CircuitOpenError:
+        print("PubCaseFinder skipped, circuit breaker is open")
+        return {"error": "The PubCaseFinder API is temporarily unavailable."}
+    except ClientClosedError:
+        print("PubCaseFinder skipped, the service is shutting down")
+        return {"error": "The PubCaseFinder API is temporarily unavailable."}
+    except TimeoutError:
+        # not a failure of the API: the calls still running record their own outcome when they finish
+        print("PubCaseFinder did not answer within the latency budget")
+        return {"error": "The PubCaseFinder API did not respond in time."}
+    except (httpx.HTTPError, ValueError) as e:
         print(f"Error querying PubCaseFinder: {e}")
         return {"error": "Failed to connect to the PubCaseFinder API."}
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    # seconds left until the deadline, None waits without limit
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+def query_pubcasefinder(hpo_ids: List[str]) -> Dict[str, Any]:
+    """
+    Queries PubCaseFinder for both ranked disease list and HPO term names.
+
+    Args:
+        hpo_ids: A list of HPO term IDs.
+
+    Returns:
+        A dictionary containing both the ranked list and HPO name data,
+        or an error message if any query fails.
+    """
+    return collect_pubcasefinder_query(start_pubcasefinder_query(hpo_ids))
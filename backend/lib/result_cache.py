@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import numpy as np
+
+from lib.encode import Encoding
+
+# rough size of one formatted syndrome/gene/patient entry of a prediction result
+RESULT_ITEM_BYTES = 512
+
+
+def hash_image(img_bytes: bytes) -> str:
+    """Cache key of an uploaded image, a hash of its (base64-decoded) file bytes."""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def estimate_nbytes(value: Any) -> int:
+    """Approximate memory held by a cached aligned face, Encoding or prediction result."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Encoding):
+        return value.representations.nbytes + sum(np.asarray(conf).nbytes for conf in value.class_conf)
+    if isinstance(value, dict):
+        return sum(len(item) * RESULT_ITEM_BYTES for item in value.values() if isinstance(item, list))
+    return 0
+
+
+class ResultCache:
+    """
+    LRU cache of the per-image results (aligned face, encodings, GestaltMatcher prediction).
+
+    Entries are keyed by hash_image() of the upload, each holding the results of the stages
+    that already ran for that image. The least recently used images are evicted once the
+    cached results exceed max_bytes. Safe to use from several worker threads.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, stage: Hashable) -> Optional[Any]:
+        """Returns the cached result of stage for the image, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or stage not in entry:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[stage][0]
+
+    def put(self, key: str, stage: Hashable, value: Any):
+        """Stores the result of stage for the image and evicts the least recently used images."""
+        nbytes = estimate_nbytes(value)
+        if self.max_bytes <= 0 or nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            self._entries.move_to_end(key)
+            if stage in entry:
+                self._nbytes -= entry[stage][1]
+            entry[stage] = (value, nbytes)
+            self._nbytes += nbytes
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= sum(size for _, size in evicted.values())
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and memory usage."""
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "images": len(self._entries),
+                    "bytes": self._nbytes,
+                    "max_bytes": self.max_bytes}
@@ -0,0 +1,79 @@
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class ComponentLoader:
+    """
+    Loads the components of the service in background threads and tracks their readiness.
+
+    Every component runs in its own thread as soon as the components it comes after are ready,
+    so independent components (models, face detector, gallery) load in parallel. A component
+    that fails, or comes after one that failed, reports the error and never becomes ready.
+    """
+
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def start(self, name: str, fn: Callable[[], Any], after: Iterable[str] = ()):
+        """Runs fn() in a background thread once the components in after are ready."""
+        state = {"ready": False, "error": None, "started": None, "seconds": None, "done": threading.Event()}
+        with self._lock:
+            self._components[name] = state
+        threading.Thread(target=self._load, args=(name, state, fn, tuple(after)),
+                         name=f"load-{name}", daemon=True).start()
+
+    def _load(self, name: str, state: Dict[str, Any], fn: Callable[[], Any], after: tuple):
+        try:
+            for dependency in after:
+                self._components[dependency]["done"].wait()
+                if not self._components[dependency]["ready"]:
+                    raise RuntimeError(f"{dependency} failed to load")
+            state["started"] = time.monotonic()
+            fn()
+            state["seconds"] = time.monotonic() - state["started"]
+            state["ready"] = True
+            print(f"Loaded {name} in {state['seconds']:.1f}s")
+        except Exception as e:
+            state["error"] = str(e) or type(e).__name__
+            print(f"Failed to load {name}:")
+            traceback.print_exc()
+        finally:
+            state["done"].set()
+
+    def started(self, name: str) -> bool:
+        return name in self._components
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every component has finished (or failed) loading; returns whether all are ready."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for state in list(self._components.values()):
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not state["done"].wait(remaining):
+                return False
+        return self.ready
+
+    @property
+    def ready(self) -> bool:
+        return bool(self._components) and all(state["ready"] for state in self._components.values())
+
+    def errors(self) -> Dict[str, str]:
+        return {name: state["error"] for name, state in self._components.items() if state["error"] is not None}
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Per component: ready, error and the load duration in seconds (so far, while loading)."""
+        now = time.monotonic()
+        result = {}
+        for name, state in list(self._components.items()):
+            if state["seconds"] is not None:
+                seconds = state["seconds"]
+            elif state["started"] is not None and state["error"] is None:
+                seconds = now - state["started"]
+            else:
+                seconds = None
+            result[name] = {"ready": state["ready"],
+                            "seconds": None if seconds is None else round(seconds, 3),
+                            "error": state["error"]}
+        return result
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import orjson
+
+from lib.json_response import dumps
+
+# expired files of the disk tier are removed on put, at most this often (seconds)
+DISK_PRUNE_INTERVAL = 60
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries expire ttl seconds after they were stored.
+
+    If disk_dir is given, entries are also written there as JSON files (one per key) and
+    looked up on a memory miss, so they survive restarts and are shared between workers.
+    Expired files are removed from time to time. Values must be JSON serializable (NumPy
+    values included, see lib.json_response.dumps). Safe to use from several threads.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 86400, disk_dir: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached value, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None and entry[0] > now:
+                self._store(key, entry)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        """Stores value and evicts the least recently used entries beyond max_size."""
+        if self.max_size <= 0:
+            return
+        now = time.time()
+        entry = (now + self.ttl, value)
+        with self._lock:
+            self._store(key, entry)
+            prune = self.disk_dir and now - self._last_prune >= DISK_PRUNE_INTERVAL
+            if prune:
+                self._last_prune = now
+        self._write_disk(key, entry)
+        if prune:
+            self._prune_disk(now)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and number of entries in memory."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode("utf8")).hexdigest() + ".json")
+
+    def _read_disk(self, key: str):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                data = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if data.get("key") != key:
+            return None
+        return data["expires"], data["value"]
+
+    def _write_disk(self, key: str, entry):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(dumps({"key": key, "expires": entry[0], "value": entry[1]}))
+            # atomic, so concurrent readers never see a partial file
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not write cache entry to disk: {e}")
+
+    def _prune_disk(self, now: float):
+        # entries expire ttl seconds after their file was written, so older files (and left over .tmp files) can go
+        try:
+            names = os.listdir(self.disk_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.disk_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
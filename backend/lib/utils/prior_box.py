@@ -1,5 +1,5 @@
 import torch
-from itertools import product as product
+from functools import lru_cache
 import numpy as np
 from math import ceil
 
@@ -15,20 +15,35 @@ class PriorBox(object):
         self.name = "s"
 
     def forward(self):
+        # [cx, cy, s_kx, s_ky] per feature map cell (row-major) and min_size, built with numpy broadcasting
         anchors = []
         for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [x * self.steps[k] / self.image_size[1] for x in [j + 0.5]]
-                    dense_cy = [y * self.steps[k] / self.image_size[0] for y in [i + 0.5]]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
+            min_sizes = np.asarray(self.min_sizes[k], dtype=np.float64)
+            cy = (np.arange(f[0]) + 0.5) * self.steps[k] / self.image_size[0]
+            cx = (np.arange(f[1]) + 0.5) * self.steps[k] / self.image_size[1]
+            # [rows, cols, min_sizes, 4]
+            anchors_k = np.empty((f[0], f[1], len(min_sizes), 4), dtype=np.float64)
+            anchors_k[..., 0] = cx[np.newaxis, :, np.newaxis]
+            anchors_k[..., 1] = cy[:, np.newaxis, np.newaxis]
+            anchors_k[..., 2] = min_sizes / self.image_size[1]
+            anchors_k[..., 3] = min_sizes / self.image_size[0]
+            anchors.append(anchors_k.reshape(-1, 4))
 
         # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
+        output = torch.from_numpy(np.concatenate(anchors).astype(np.float32))
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
+
+
+@lru_cache(maxsize=64)
+def _cached_priors(min_sizes, steps, clip, image_size, device):
+    cfg = {'min_sizes': min_sizes, 'steps': steps, 'clip': clip}
+    return PriorBox(cfg, image_size=image_size).forward().to(device)
+
+
+def get_priors(cfg, image_size, device='cpu'):
+    # Priors of PriorBox(cfg, image_size).forward() on device, cached per config, (height, width) and device,
+    # since they only depend on these; shared between calls, so do not modify them in place
+    return _cached_priors(tuple(tuple(min_sizes) for min_sizes in cfg['min_sizes']), tuple(cfg['steps']),
+                          cfg['clip'], tuple(image_size), str(device))
@@ -135,13 +135,16 @@ def resize_crop_with_ratio_squared(img, bbox, max_dim_size, pad_color=0, interpo
 
 def readb64(uri):
     # encoded_data = uri.split(',')[1]
-    nparr = np.fromstring(base64.b64decode(uri), np.uint8)
+    return decode_img(base64.b64decode(uri))
+
+
+def decode_img(img_bytes):
+    # decode the bytes of an image file (png, jpg, ...) without copying them
+    nparr = np.frombuffer(img_bytes, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     return img
 
 
 def encodeb64(uri):
     # encoded_data = uri.split(',')[1]
-    nparr = np.fromstring(base64.b64decode(uri), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return img
\ No newline at end of file
+    return decode_img(base64.b64decode(uri))
\ No newline at end of file
@@ -1,24 +1,40 @@
 import base64
+import gc
 import pickle
 import secrets
 import time
 import json
 import cv2
-from typing import Annotated, List, Optional
+from typing import Annotated, List, Literal, Optional
 from lib.encode import *
+import torch
 from lib.evaluation import *
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from lib.face_alignment import *
 from contextlib import asynccontextmanager
-from lib.utils_functions import readb64, encodeb64
+from lib.utils_functions import readb64, encodeb64, decode_img
 from datetime import datetime
-from lib.pubcasefinder import query_pubcasefinder
+from lib.pubcasefinder import start_pubcasefinder_query, collect_pubcasefinder_query
+from lib import pubcasefinder
+from lib.local_pubcasefinder import LocalPhenotypeIndex
 from lib.integrator import integrate_json
-
-from fastapi import Depends, FastAPI, HTTPException, status, APIRouter
+from lib.inference_pool import InferencePool, InferencePoolFull
+from lib.micro_batcher import MicroBatcher
+from lib.result_cache import ResultCache, hash_image
+from lib.ttl_cache import TTLCache
+from lib.json_response import FastJSONResponse
+from lib.centroid_index import CentroidIndex
+from lib.gallery_index import ExactGalleryIndex, IVFGalleryIndex
+from lib.gallery_store import load_gallery_matrix, metadata_fingerprint
+from lib.startup import ComponentLoader
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, status, APIRouter
+from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import FileResponse
+from starlette.datastructures import UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 
 import os
@@ -30,6 +46,78 @@ with open('config.json', 'r') as config_file:
 
 USERNAME = config.get('username')
 PASSWORD = config.get('password')
+# number of syndromes/genes/subjects to rank per request, 'all' ranks the whole gallery
+TOP_N = config.get('top_n', 'all')
+# number of requests running inference at the same time, and how many more may wait for a worker
+INFERENCE_WORKERS = config.get('inference_workers', 2)
+INFERENCE_QUEUE_SIZE = config.get('inference_queue_size', 8)
+# aligned faces of concurrent requests are encoded together, up to this many images (at most one per
+# inference worker, larger values have no effect) or this long a wait while several faces are queued
+BATCH_MAX_SIZE = min(config.get('batch_max_size', INFERENCE_WORKERS), INFERENCE_WORKERS)
+BATCH_MAX_WAIT_MS = config.get('batch_max_wait_ms', 5)
+# memory for caching aligned faces, encodings and predictions of resubmitted images, 0 disables the cache
+RESULT_CACHE_MB = config.get('result_cache_mb', 256)
+# PubCaseFinder API, its timeouts in seconds and whether to use HTTP/2 (needs the h2 package)
+PUBCASEFINDER_URL = config.get('pubcasefinder_url', pubcasefinder.PCF_BASE_URL)
+PUBCASEFINDER_CONNECT_TIMEOUT = config.get('pubcasefinder_connect_timeout', 5)
+PUBCASEFINDER_READ_TIMEOUT = config.get('pubcasefinder_read_timeout', 30)
+PUBCASEFINDER_HTTP2 = config.get('pubcasefinder_http2', True)
+# PubCaseFinder responses are cached per HPO ID set (and HPO names per term) for this many seconds
+PUBCASEFINDER_CACHE_SIZE = config.get('pubcasefinder_cache_size', 1024)
+PUBCASEFINDER_CACHE_TTL = config.get('pubcasefinder_cache_ttl', 86400)
+PUBCASEFINDER_CACHE_DIR = config.get('pubcasefinder_cache_dir')
+PUBCASEFINDER_CACHE_PER_TERM = config.get('pubcasefinder_cache_per_term', True)
+# 'api' queries pubcasefinder.dbcls.jp, 'local' ranks with the local HPO annotation files below
+PUBCASEFINDER_BACKEND = config.get('pubcasefinder_backend', 'api')
+LOCAL_HPO_ANNOTATIONS = config.get('local_hpo_annotations', os.path.join('data', 'hpo', 'phenotype.hpoa'))
+LOCAL_HPO_GENES = config.get('local_hpo_genes', os.path.join('data', 'hpo', 'genes_to_disease.txt'))
+LOCAL_HPO_ONTOLOGY = config.get('local_hpo_ontology', os.path.join('data', 'hpo', 'hp.obo'))
+# skip the PubCaseFinder API for a cool-down (s) after this many consecutive failures
+PUBCASEFINDER_BREAKER_FAILURES = config.get('pubcasefinder_breaker_failures', 3)
+PUBCASEFINDER_BREAKER_COOLDOWN = config.get('pubcasefinder_breaker_cooldown', 60)
+# default time (s) from receiving /predict until PubCaseFinder results are given up on
+PUBCASEFINDER_BUDGET = config.get('pubcasefinder_budget', 20)
+# number of entries per suggested_* list returned by /predict unless the request sets it, None returns all
+RESPONSE_TOP_N = config.get('response_top_n')
+# truncated /predict results are kept this many seconds for fetching further pages, at most this many results
+# in memory per worker; the directory shares them between the workers, None keeps them in the worker only
+RESULT_HANDLE_TTL = config.get('result_handle_ttl', 300)
+RESULT_HANDLE_COUNT = config.get('result_handle_count', 32)
+RESULT_HANDLE_DIR = config.get('result_handle_dir', os.path.join('data', 'result_handles'))
+# responses of at least this many bytes are compressed (Brotli or gzip, as the client accepts), None disables it
+RESPONSE_COMPRESS_MIN_BYTES = config.get('response_compress_min_bytes', 1024)
+
+# most images accepted by one /predict/batch or /predict/patient request
+BATCH_PREDICT_MAX_IMAGES = config.get('batch_predict_max_images', 32)
+# gallery search: 'exact' compares every image, 'centroid' only the images of the nearest syndrome and
+# patient centroids, 'ivf' only the nearest lists of the index built with build_gallery_index.py
+GALLERY_INDEX = config.get('gallery_index', 'exact')
+CENTROID_PREFILTER_SYNDS = config.get('centroid_prefilter_synds', 50)
+CENTROID_PREFILTER_SUBJECTS = config.get('centroid_prefilter_subjects', 100)
+IVF_INDEX_PATH = config.get('ivf_index_path', os.path.join('data', 'gallery_index', 'gallery_ivf.npz'))
+IVF_N_PROBE = config.get('ivf_n_probe', 8)
+# gallery matrix written by convert_gallery_encodings.py, memory-mapped at startup; if the file does not
+# exist, the gallery is read from the encodings pickle instead
+GALLERY_MATRIX_PATH = config.get('gallery_matrix_path', os.path.join(
+    'data', 'gallery_encodings', 'GMDB_gallery_encodings_20082024_v1.1.0_service.npy'))
+# how /predict/patient combines the images of a patient: 'mean' embedding or 'late' fusion of the distances
+PATIENT_FUSION = config.get('patient_fusion', 'mean')
+# intra-op threads of the models in each worker, e.g. cores / workers; None keeps torch's default
+TORCH_THREADS = config.get('torch_threads')
+# run one inference per worker at startup, before /api/ready reports the worker as ready
+STARTUP_WARMUP = config.get('startup_warmup', True)
+
+# loading state of the models, gallery and warmup; the shared resources are loaded once per process,
+# or once in the gunicorn master (see gunicorn.conf.py)
+SHARED_COMPONENTS = ('models', 'cropper', 'gallery')
+_loader = ComponentLoader()
+_preloaded = False
+_encoder = None
+
+# names of the paginated lists in the /predict result
+RESULT_LISTS = {'syndromes': 'suggested_syndromes_list',
+                'genes': 'suggested_genes_list',
+                'patients': 'suggested_patients_list'}
 
 def get_current_username(
         credentials: Annotated[HTTPBasicCredentials, Depends(security)]
@@ -54,27 +142,132 @@ def get_current_username(
     return credentials.username
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+def load_gallery_index():
+    if GALLERY_INDEX == 'exact':
+        return ExactGalleryIndex()
+    if GALLERY_INDEX == 'centroid':
+        return CentroidIndex(_gallery_representations, _gallery_labels,
+                             CENTROID_PREFILTER_SYNDS, CENTROID_PREFILTER_SUBJECTS)
+    if GALLERY_INDEX == 'ivf':
+        return IVFGalleryIndex.load(IVF_INDEX_PATH, _gallery_df["img_name"].values, IVF_N_PROBE)
+    raise ValueError(f"Unknown gallery_index '{GALLERY_INDEX}', use 'exact', 'centroid' or 'ivf'")
+
+
+def load_gallery(metadata_bytes):
+    # (gallery_df, gallery_representations, gallery_labels), from the memory-mapped matrix if converted
+    if GALLERY_MATRIX_PATH and os.path.exists(GALLERY_MATRIX_PATH):
+        return load_gallery_matrix(GALLERY_MATRIX_PATH, metadata_fingerprint(metadata_bytes))
+    print(f"No gallery matrix {GALLERY_MATRIX_PATH}, reading the encodings pickle "
+          f"(run convert_gallery_encodings.py for a faster startup)")
+    gallery_df = get_gallery_encodings_set(_images_synds_dict)
+    return (gallery_df,
+            build_gallery_representations(gallery_df),
+            build_gallery_labels(gallery_df, _images_synds_dict, _images_genes_dict))
+
+
+def load_models():
     global _models
-    global _device
+    _models = get_models()
+
+
+def load_cropper():
     global _cropper_model
+    global _device
+    _cropper_model, _device = load_cropper_model()
+
+
+def load_metadata_and_gallery():
     global _gallery_df
+    global _gallery_representations
+    global _gallery_labels
+    global _gallery_index
     global _images_synds_dict
     global _images_genes_dict
     global _genes_metadata_dict
     global _synds_metadata_dict
-    _models = get_models()
-    _cropper_model, _device = load_cropper_model()
     # Load synd dict
     with open(os.path.join("data", "image_gene_and_syndrome_metadata_20082024.p"), "rb") as f:
-        data = pickle.load(f)
+        metadata_bytes = f.read()
+    data = pickle.loads(metadata_bytes)
     _images_synds_dict = data["disorder_level_metadata"]
     _images_genes_dict = data["gene_level_metadata"]
     _genes_metadata_dict = data["gene_metadata"]
     _synds_metadata_dict = data["disorder_metadata"]
-    _gallery_df = get_gallery_encodings_set(_images_synds_dict)
+    _gallery_df, _gallery_representations, _gallery_labels = load_gallery(metadata_bytes)
+    _gallery_index = load_gallery_index()
+    if PUBCASEFINDER_BACKEND == 'local':
+        pubcasefinder.use_local_index(LocalPhenotypeIndex(LOCAL_HPO_ANNOTATIONS, LOCAL_HPO_GENES, LOCAL_HPO_ONTOLOGY))
+
+
+def start_loading_shared_resources():
+    # Read-only state used by every request, loaded in parallel background threads. Loaded once by
+    # preload_shared_resources() in the gunicorn master, or else by the lifespan of each worker
+    if _loader.started('models'):
+        return
+    _loader.start('models', load_models)
+    _loader.start('cropper', load_cropper)
+    _loader.start('gallery', load_metadata_and_gallery)
+
+
+def warm_up():
+    # Per worker, once the shared resources are ready: start the micro-batcher and run one inference on a
+    # synthetic image, so the first request does not pay for lazy initializations and the first gallery reads
+    global _encoder
+    _encoder = MicroBatcher(_models, 'cpu', BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+    if not STARTUP_WARMUP:
+        return
+    try:
+        face_align_crop(_cropper_model, np.full((640, 640, 3), 128, dtype=np.uint8), _device)
+    except Exception:
+        # no face in the synthetic image, the detector ran nonetheless
+        pass
+    encoding = _encoder.encode(np.full((112, 112, 3), 128, dtype=np.uint8), False, False)
+    predict(encoding, _gallery_df, _images_synds_dict, _images_genes_dict, _genes_metadata_dict,
+            _synds_metadata_dict, _gallery_representations, TOP_N, _gallery_labels, _gallery_index)
+
+
+def preload_shared_resources():
+    # Preload-then-fork (gunicorn.conf.py): called in the gunicorn master before the workers are forked,
+    # which then share the loaded pages copy-on-write. No inference runs here, the workers create their own
+    # threads. gc.freeze() moves the loaded objects out of the collector's reach, so collections in the workers
+    # do not write to (and thereby copy) their pages
+    global _preloaded
+    start_loading_shared_resources()
+    if not _loader.wait():
+        raise RuntimeError(f"Failed to load {_loader.errors()}")
+    _preloaded = True
+    gc.collect()
+    gc.freeze()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _inference_pool
+    global _result_cache
+    global _result_handles
+    # the service answers right away, /api/ready reports when the models and gallery are loaded and warmed up
+    start_loading_shared_resources()
+    _loader.start('warmup', warm_up, after=SHARED_COMPONENTS)
+    # per worker: threads, caches and the HTTP client are not shared across processes
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    _inference_pool = InferencePool(INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+    _result_cache = ResultCache(RESULT_CACHE_MB * 1024 * 1024)
+    _result_handles = TTLCache(RESULT_HANDLE_COUNT, RESULT_HANDLE_TTL, RESULT_HANDLE_DIR)
+    pubcasefinder.open_client(PUBCASEFINDER_URL,
+                              PUBCASEFINDER_CONNECT_TIMEOUT,
+                              PUBCASEFINDER_READ_TIMEOUT,
+                              http2=PUBCASEFINDER_HTTP2)
+    pubcasefinder.configure_cache(PUBCASEFINDER_CACHE_SIZE,
+                                  PUBCASEFINDER_CACHE_TTL,
+                                  PUBCASEFINDER_CACHE_DIR,
+                                  PUBCASEFINDER_CACHE_PER_TERM)
+    pubcasefinder.configure_circuit_breaker(PUBCASEFINDER_BREAKER_FAILURES, PUBCASEFINDER_BREAKER_COOLDOWN)
     yield
+    pubcasefinder.close_client()
+    _inference_pool.shutdown()
+    if _encoder is not None:
+        _encoder.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -97,14 +290,219 @@ api_router = APIRouter(prefix="/api")
 class ImageRequest(BaseModel):
     img: str
 
-class PredictRequest(BaseModel):
+class PredictOptions(BaseModel):
+    hpo_ids: Optional[List[str]] = None
+    # seconds to wait at most for PubCaseFinder, counted from receiving the request
+    pubcasefinder_budget: Optional[float] = Field(default=None, gt=0)
+    # number of entries to return for all lists, or per list; the rest can be fetched from /predict/{result_id}
+    top_n: Optional[int] = Field(default=None, ge=0)
+    syndromes_top_n: Optional[int] = Field(default=None, ge=0)
+    genes_top_n: Optional[int] = Field(default=None, ge=0)
+    patients_top_n: Optional[int] = Field(default=None, ge=0)
+
+class PredictRequest(PredictOptions):
+    img: str
+
+class BatchImage(BaseModel):
     img: str
     hpo_ids: Optional[List[str]] = None
 
+class PredictBatchRequest(PredictOptions):
+    # hpo_ids of the request are used for the images without their own
+    images: List[BatchImage]
+
+class PredictPatientRequest(PredictOptions):
+    # several images of the same patient
+    images: List[str]
+    fusion: Optional[Literal['mean', 'late']] = None
+
+# request body of the binary upload endpoints, which parse it themselves
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {"type": "object",
+                           "required": ["img"],
+                           "properties": {"img": {"type": "string", "format": "binary"}}}},
+            "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+        },
+    }
+}
+
+
+def admit_inference():
+    # reject with 503 while starting up or when the inference pool is saturated; run_inference is then admitted too
+    # unless the caller awaits in between, so work started in between (PubCaseFinder queries) is never sent in vain
+    if not _loader.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is starting, please retry later.",
+            headers={"Retry-After": "10"},
+        )
+    if _inference_pool.full:
+        raise busy_error()
+
+
+def busy_error():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry later.",
+        headers={"Retry-After": "5"},
+    )
+
+
+async def run_inference(fn, *args):
+    # Run the blocking work in the inference pool, see admit_inference
+    admit_inference()
+    try:
+        return await _inference_pool.run(fn, *args)
+    except InferencePoolFull:
+        raise busy_error()
+
+
+async def read_upload(request: Request):
+    # image file bytes and options of a multipart/form-data (file field 'img') or application/octet-stream upload;
+    # the options are form fields or, for octet-stream, query parameters
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        upload = form.get('img')
+        if not isinstance(upload, UploadFile):
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail="Missing image file field 'img'.")
+        img_bytes, params = await upload.read(), form
+    elif content_type.startswith('application/octet-stream'):
+        img_bytes, params = await request.body(), request.query_params
+    else:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Upload the image as multipart/form-data or application/octet-stream.")
+    if not img_bytes:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Empty image.")
+    return img_bytes, params
+
+
+def parse_predict_options(params) -> PredictOptions:
+    # HPO IDs may be repeated and/or comma-separated
+    hpo_ids = [hpo_id.strip() for value in params.getlist('hpo_ids') for hpo_id in value.split(',') if hpo_id.strip()]
+    fields = {key: params[key] for key in PredictOptions.model_fields if key != 'hpo_ids' and key in params}
+    try:
+        return PredictOptions(hpo_ids=hpo_ids or None, **fields)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+def to_img_bytes(img):
+    # base64 string of the JSON endpoints, or the file bytes of the upload endpoints
+    return base64.b64decode(img) if isinstance(img, str) else img
+
+
+def get_aligned_img(img_bytes, img_key):
+    # aligned face of the image, from the result cache if it was uploaded before
+    aligned_img = _result_cache.get(img_key, 'aligned')
+    if aligned_img is None:
+        img = decode_img(img_bytes)
+        aligned_img = face_align_crop(_cropper_model, img, _device)
+        _result_cache.put(img_key, 'aligned', aligned_img)
+    return aligned_img
+
+
+def get_encoding(aligned_img, img_key, flip_flag=True, gray_flag=True):
+    stage = ('encoding', flip_flag, gray_flag)
+    encoding = _result_cache.get(img_key, stage)
+    if encoding is None:
+        encoding = _encoder.encode(aligned_img, flip_flag, gray_flag)
+        _result_cache.put(img_key, stage, encoding)
+    return encoding
+
+
+async def json_response(content, request: Request):
+    # serialized with orjson (NumPy values included) instead of jsonable_encoder, compressed if the client accepts it;
+    # large bodies are compressed in a thread, off the event loop
+    return await FastJSONResponse.create(content, request, RESPONSE_COMPRESS_MIN_BYTES)
+
+
+def copy_result(result):
+    # integrate_json updates the lists and their items in place, so hand out copies of cached results
+    return {key: [dict(item) for item in value] if isinstance(value, list) else value
+            for key, value in result.items()}
+
+
+def get_encodings(aligned_imgs, img_keys, flip_flag=False, gray_flag=False):
+    # encodings of several aligned faces ({index: image}), the uncached ones encoded in one batch per model
+    stage = ('encoding', flip_flag, gray_flag)
+    encodings = {i: _result_cache.get(img_keys[i], stage) for i in aligned_imgs}
+    to_encode = [i for i, encoding in encodings.items() if encoding is None]
+    if to_encode:
+        batch = encode_batch(_models, 'cpu', [aligned_imgs[i] for i in to_encode], flip_flag, gray_flag)
+        for i, encoding in zip(to_encode, batch):
+            encodings[i] = encoding
+            _result_cache.put(img_keys[i], stage, encoding)
+    return encodings
+
+
+def combine_results(gestaltmatcher_result, hpo_ids, pcf_query, pcf_deadline):
+    # copy of the (possibly cached) GestaltMatcher result with the PubCaseFinder result, if HPO IDs were given
+    final_result = copy_result(gestaltmatcher_result)
+    if hpo_ids:
+        final_result['pubcasefinder'] = collect_pubcasefinder_query(pcf_query, pcf_deadline)
+        final_result['queried_hpo_ids'] = hpo_ids
+    return final_result
+
+
+def integrate_result(result, request_data: PredictOptions):
+    # rank the suggested_* lists with PubCaseFinder, only up to the requested sizes; the unranked
+    # full lists are kept so that later pages are ranked on demand
+    limits = {}
+    for name, key in RESULT_LISTS.items():
+        limit = getattr(request_data, f'{name}_top_n')
+        if limit is None:
+            limit = request_data.top_n if request_data.top_n is not None else RESPONSE_TOP_N
+        if limit is not None and key in result and len(result[key]) > limit:
+            limits[key] = limit
+    if not limits:
+        return integrate_json(result)
+
+    result_id = secrets.token_urlsafe(16)
+    lists = {key: result[key] for key in RESULT_LISTS.values() if key in result}
+    _result_handles.put(result_id, {**lists, 'pubcasefinder': result.get('pubcasefinder')})
+    result['result_id'] = result_id
+    result['list_totals'] = {name: len(result[key]) for name, key in RESULT_LISTS.items() if key in result}
+    return integrate_json(result, top_n=limits)
+
 
 @api_router.post("/predict")
-async def predict_endpoint(username: Annotated[str, Depends(get_current_username)], request_data: PredictRequest):
-    img = readb64(request_data.img)
+async def predict_endpoint(username: Annotated[str, Depends(get_current_username)], request_data: PredictRequest,
+                           request: Request):
+    return await json_response(await start_predict(request_data, request_data.img), request)
+
+
+@api_router.post("/predict/upload", openapi_extra=UPLOAD_OPENAPI)
+async def predict_upload_endpoint(username: Annotated[str, Depends(get_current_username)], request: Request):
+    img_bytes, params = await read_upload(request)
+    return await json_response(await start_predict(parse_predict_options(params), img_bytes), request)
+
+
+def pubcasefinder_deadline(request_data: PredictOptions):
+    # time.monotonic() until which PubCaseFinder is waited for, from the request's budget or the default
+    budget = request_data.pubcasefinder_budget
+    if budget is None:
+        budget = PUBCASEFINDER_BUDGET
+    return time.monotonic() + budget
+
+
+async def start_predict(request_data: PredictOptions, img):
+    # the PubCaseFinder requests only depend on the HPO IDs, so they run while the image is analyzed;
+    # they are only sent once the request is admitted
+    pcf_deadline = pubcasefinder_deadline(request_data)
+    admit_inference()
+    pcf_query = start_pubcasefinder_query(request_data.hpo_ids)
+    return await run_inference(run_predict, request_data, img, pcf_query, pcf_deadline)
+
+
+def run_predict(request_data: PredictOptions, img, pcf_query=None, pcf_deadline=None):
+    img_bytes = to_img_bytes(img)
+    img_key = hash_image(img_bytes)
     hpo_ids = request_data.hpo_ids
 
     if hpo_ids:
@@ -115,65 +513,298 @@ async def predict_endpoint(username: Annotated[str, Depends(get_current_username
     start_time = time.time()
     
     try:
-        aligned_img = face_align_crop(_cropper_model, img, _device)
+        aligned_img = get_aligned_img(img_bytes, img_key)
     except Exception as e:
         return {"message": "Face alignment error."}
     align_time = time.time()
     try:
-        encoding = encode(_models, 'cpu', aligned_img, False, False)
+        encoding = get_encoding(aligned_img, img_key, False, False)
     except Exception as e:
         return {"message": "Encoding error."}
     encode_time = time.time()
  
     try:
-        # Step 1: Run the original GestaltMatcher analysis
-        gestaltmatcher_result = predict(encoding,
-                                      _gallery_df,
-                                      _images_synds_dict,
-                                      _images_genes_dict,
-                                      _genes_metadata_dict,
-                                      _synds_metadata_dict)
-
-        # Step 2: If HPO IDs are provided, query PubCaseFinder
-        if hpo_ids:
-            pubcasefinder_result = query_pubcasefinder(hpo_ids)
-            final_result = gestaltmatcher_result.copy()
-            final_result['pubcasefinder'] = pubcasefinder_result
-            final_result['queried_hpo_ids'] = hpo_ids
-        else:
-            final_result = gestaltmatcher_result
+        # Step 1: Run the original GestaltMatcher analysis, unless the image was analyzed before
+        gestaltmatcher_result = _result_cache.get(img_key, 'gestaltmatcher')
+        if gestaltmatcher_result is None:
+            gestaltmatcher_result = predict(encoding,
+                                          _gallery_df,
+                                          _images_synds_dict,
+                                          _images_genes_dict,
+                                          _genes_metadata_dict,
+                                          _synds_metadata_dict,
+                                          _gallery_representations,
+                                          TOP_N,
+                                          _gallery_labels,
+                                          _gallery_index)
+            _result_cache.put(img_key, 'gestaltmatcher', gestaltmatcher_result)
+
+        # Step 2: If HPO IDs are provided, wait for the PubCaseFinder query started with the request
+        final_result = combine_results(gestaltmatcher_result, hpo_ids, pcf_query, pcf_deadline)
+
+    except Exception as e:
+        print(f"Evaluation or combination error: {e}")
+        return {"message": "Evaluation error."}
+    finished_time = time.time()
+
+    print('Crop: {:.2f}s'.format(align_time-start_time))
+    print('Encode: {:.2f}s'.format(encode_time-align_time))
+    print('Predict: {:.2f}s'.format(finished_time-encode_time))
+    print('Total: {:.2f}s'.format(finished_time-start_time))
+
+    return integrate_result(final_result, request_data)
+
+
+@api_router.post("/predict/batch")
+async def predict_batch_endpoint(username: Annotated[str, Depends(get_current_username)],
+                                 request_data: PredictBatchRequest,
+                                 request: Request):
+    if not 0 < len(request_data.images) <= BATCH_PREDICT_MAX_IMAGES:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Send between 1 and {BATCH_PREDICT_MAX_IMAGES} images.")
+    pcf_deadline = pubcasefinder_deadline(request_data)
+    hpo_ids_list = [image.hpo_ids or request_data.hpo_ids for image in request_data.images]
+    admit_inference()
+    pcf_queries = [start_pubcasefinder_query(hpo_ids) for hpo_ids in hpo_ids_list]
+    results = await run_inference(run_predict_batch, request_data, hpo_ids_list, pcf_queries, pcf_deadline)
+    return await json_response({"results": results}, request)
+
+
+def run_predict_batch(request_data: PredictBatchRequest, hpo_ids_list, pcf_queries, pcf_deadline):
+    # Detect the faces one by one, then encode all of them in one batch per model and
+    # rank all of them against the gallery at once
+    n_images = len(request_data.images)
+    results = [None] * n_images
+    img_keys = [None] * n_images
+    gestaltmatcher_results = [None] * n_images
+    start_time = time.time()
+
+    aligned_imgs = {}
+    for i, image in enumerate(request_data.images):
+        try:
+            img_bytes = to_img_bytes(image.img)
+            img_keys[i] = hash_image(img_bytes)
+            gestaltmatcher_results[i] = _result_cache.get(img_keys[i], 'gestaltmatcher')
+            if gestaltmatcher_results[i] is None:
+                aligned_imgs[i] = get_aligned_img(img_bytes, img_keys[i])
+        except Exception as e:
+            results[i] = {"message": "Face alignment error."}
+    align_time = time.time()
+
+    try:
+        encodings = get_encodings(aligned_imgs, img_keys)
+    except Exception as e:
+        print(f"Encoding error: {e}")
+        for i in aligned_imgs:
+            results[i] = {"message": "Encoding error."}
+        encodings = {}
+    encode_time = time.time()
+
+    try:
+        if encodings:
+            batch = predict_batch(list(encodings.values()),
+                                  _gallery_df,
+                                  _images_synds_dict,
+                                  _images_genes_dict,
+                                  _genes_metadata_dict,
+                                  _synds_metadata_dict,
+                                  _gallery_representations,
+                                  TOP_N,
+                                  _gallery_labels,
+                                  _gallery_index)
+            for i, gestaltmatcher_result in zip(encodings, batch):
+                gestaltmatcher_results[i] = gestaltmatcher_result
+                _result_cache.put(img_keys[i], 'gestaltmatcher', gestaltmatcher_result)
+    except Exception as e:
+        print(f"Evaluation error: {e}")
+        for i in encodings:
+            results[i] = {"message": "Evaluation error."}
+    predict_time = time.time()
+
+    for i in range(n_images):
+        if results[i] is not None:
+            continue
+        try:
+            final_result = combine_results(gestaltmatcher_results[i], hpo_ids_list[i], pcf_queries[i], pcf_deadline)
+            results[i] = integrate_result(final_result, request_data)
+        except Exception as e:
+            print(f"Evaluation or combination error: {e}")
+            results[i] = {"message": "Evaluation error."}
+    finished_time = time.time()
+
+    print('Batch of {} images'.format(n_images))
+    print('Crop: {:.2f}s'.format(align_time-start_time))
+    print('Encode: {:.2f}s'.format(encode_time-align_time))
+    print('Predict: {:.2f}s'.format(predict_time-encode_time))
+    print('Total: {:.2f}s'.format(finished_time-start_time))
+    return results
+
+
+@api_router.post("/predict/patient")
+async def predict_patient_endpoint(username: Annotated[str, Depends(get_current_username)],
+                                   request_data: PredictPatientRequest,
+                                   request: Request):
+    if not 0 < len(request_data.images) <= BATCH_PREDICT_MAX_IMAGES:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Send between 1 and {BATCH_PREDICT_MAX_IMAGES} images.")
+    pcf_deadline = pubcasefinder_deadline(request_data)
+    admit_inference()
+    pcf_query = start_pubcasefinder_query(request_data.hpo_ids)
+    result = await run_inference(run_predict_patient, request_data, pcf_query, pcf_deadline)
+    return await json_response(result, request)
+
+
+def run_predict_patient(request_data: PredictPatientRequest, pcf_query=None, pcf_deadline=None):
+    # One prediction for several images of a patient: the faces are encoded in one batch, fused and
+    # searched in the gallery once. Images without a detectable face are skipped
+    fusion = request_data.fusion or PATIENT_FUSION
+    start_time = time.time()
+
+    img_keys = [None] * len(request_data.images)
+    aligned_imgs = {}
+    skipped_images = []
+    for i, img in enumerate(request_data.images):
+        try:
+            img_bytes = to_img_bytes(img)
+            img_keys[i] = hash_image(img_bytes)
+            aligned_imgs[i] = get_aligned_img(img_bytes, img_keys[i])
+        except Exception as e:
+            skipped_images.append(i)
+    if not aligned_imgs:
+        return {"message": "Face alignment error."}
+    align_time = time.time()
 
+    try:
+        encodings = get_encodings(aligned_imgs, img_keys)
+    except Exception as e:
+        return {"message": "Encoding error."}
+    encode_time = time.time()
+
+    try:
+        # the fused result only depends on the set of images and the fusion
+        patient_key = hash_image('{}:{}'.format(fusion, ','.join(sorted(set(img_keys[i] for i in encodings))))
+                                 .encode('utf8'))
+        gestaltmatcher_result = _result_cache.get(patient_key, 'gestaltmatcher')
+        if gestaltmatcher_result is None:
+            gestaltmatcher_result = predict_patient(list(encodings.values()),
+                                                    _gallery_df,
+                                                    _images_synds_dict,
+                                                    _images_genes_dict,
+                                                    _genes_metadata_dict,
+                                                    _synds_metadata_dict,
+                                                    _gallery_representations,
+                                                    TOP_N,
+                                                    _gallery_labels,
+                                                    fusion,
+                                                    _gallery_index)
+            _result_cache.put(patient_key, 'gestaltmatcher', gestaltmatcher_result)
+        final_result = combine_results(gestaltmatcher_result, request_data.hpo_ids, pcf_query, pcf_deadline)
+        final_result['fusion'] = fusion
+        final_result['skipped_images'] = skipped_images
     except Exception as e:
         print(f"Evaluation or combination error: {e}")
         return {"message": "Evaluation error."}
     finished_time = time.time()
 
+    print('Patient with {} images ({} fusion)'.format(len(encodings), fusion))
     print('Crop: {:.2f}s'.format(align_time-start_time))
     print('Encode: {:.2f}s'.format(encode_time-align_time))
     print('Predict: {:.2f}s'.format(finished_time-encode_time))
     print('Total: {:.2f}s'.format(finished_time-start_time))
 
-    return integrate_json(final_result)
+    return integrate_result(final_result, request_data)
+
+
+def rank_page(stored, key, end):
+    # the first end entries of a stored list, ranked on copies as integrate_json updates the items
+    result = {key: [dict(item) for item in stored[key]], 'pubcasefinder': stored['pubcasefinder']}
+    return integrate_json(result, top_n=end)[key]
+
+
+@api_router.get("/predict/{result_id}/{list_name}")
+async def predict_page_endpoint(username: Annotated[str, Depends(get_current_username)],
+                                request: Request,
+                                result_id: str,
+                                list_name: str,
+                                offset: Annotated[int, Query(ge=0)] = 0,
+                                limit: Annotated[int, Query(gt=0)] = 50):
+    # further entries of a truncated /predict result, without running the prediction again
+    if list_name not in RESULT_LISTS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Unknown list, use one of: {', '.join(RESULT_LISTS)}")
+    key = RESULT_LISTS[list_name]
+    stored = _result_handles.get(result_id)
+    if stored is None or key not in stored:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Result not found or expired, please submit the image again.")
+    total = len(stored[key])
+    next_offset = offset + limit
+    page = (await run_in_threadpool(rank_page, stored, key, next_offset))[offset:]
+    return await json_response({"result_id": result_id,
+                          "list": list_name,
+                          "offset": offset,
+                          "total": total,
+                          "items": page,
+                          "next_offset": next_offset if next_offset < total else None}, request)
 
 
 @api_router.post("/encode")
-async def encode_endpoint(image: ImageRequest):
-    img = readb64(image.img)
-    aligned_img = face_align_crop(_cropper_model, img, _device)
-    return {"encodings": encode(_models, 'cpu', aligned_img).to_dict()}
+async def encode_endpoint(image: ImageRequest, request: Request):
+    return await json_response(await run_inference(run_encode, image.img), request)
+
+
+@api_router.post("/encode/upload", openapi_extra=UPLOAD_OPENAPI)
+async def encode_upload_endpoint(request: Request):
+    img_bytes, _ = await read_upload(request)
+    return await json_response(await run_inference(run_encode, img_bytes), request)
+
+
+def run_encode(img):
+    img_bytes = to_img_bytes(img)
+    img_key = hash_image(img_bytes)
+    aligned_img = get_aligned_img(img_bytes, img_key)
+    return {"encodings": get_encoding(aligned_img, img_key).to_dict()}
 
 
 @api_router.post("/crop")
-async def crop_endpoint(image: ImageRequest):
-    img = readb64(image.img)
-    aligned_img = face_align_crop(_cropper_model, img, _device)
+async def crop_endpoint(image: ImageRequest, request: Request):
+    return await json_response(await run_inference(run_crop, image.img), request)
+
+
+@api_router.post("/crop/upload", openapi_extra=UPLOAD_OPENAPI)
+async def crop_upload_endpoint(request: Request):
+    img_bytes, _ = await read_upload(request)
+    return await json_response(await run_inference(run_crop, img_bytes), request)
+
+
+def run_crop(img):
+    img_bytes = to_img_bytes(img)
+    aligned_img = get_aligned_img(img_bytes, hash_image(img_bytes))
     img_en = cv2.imencode(".png", aligned_img)
     return {"crop": base64.b64encode(img_en[1])}
 
 
+@api_router.get("/ready")
+async def ready_endpoint():
+    # readiness, unlike /status (liveness): 503 until the models and gallery are loaded and the worker is warmed up
+    content = {"ready": _loader.ready,
+               "preloaded": _preloaded,
+               "components": _loader.status()}
+    return FastJSONResponse(content, status_code=status.HTTP_200_OK if content["ready"]
+                            else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 @api_router.get("/status")
 async def status_endpoint():
-    return {"status": "running"}
+    return {"status": "running",
+            "pid": os.getpid(),
+            "preloaded": _preloaded,
+            "ready": _loader.ready,
+            "gallery_index": GALLERY_INDEX,
+            "result_cache": _result_cache.stats(),
+            "pubcasefinder_cache": pubcasefinder.cache_stats(),
+            "pubcasefinder_breaker": pubcasefinder.breaker_stats(),
+            "result_handles": _result_handles.stats()}
 
 
 app.include_router(api_router)
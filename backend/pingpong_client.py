@@ -38,6 +38,11 @@ def main():
         default="your_password",
         help="Password for API authentication.\n(default: your_password)"
     )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Upload the image file as multipart/form-data to <url>/upload instead of base64 in JSON."
+    )
     parser.add_argument(
         "--no-verify",
         action="store_true",
@@ -53,27 +58,37 @@ def main():
 
     try:
         with open(args.image_path, "rb") as image_file:
-            # Encode image to Base64 and decode to a UTF-8 string for the JSON payload
-            image_b64 = base64.b64encode(image_file.read()).decode('utf-8')
+            image_bytes = image_file.read()
     except IOError as e:
         print(f"Error: Could not read image file: {e}", file=sys.stderr)
         sys.exit(1)
 
-    # --- 2. Construct the JSON payload ---
-    payload = {
-        "img": image_b64
-    }
-    if args.hpo:
-        # Split the comma-separated string into a list of HPO IDs
-        hpo_ids = [hpo_id.strip() for hpo_id in args.hpo.split(',')]
-        payload["hpo_ids"] = hpo_ids
+    # --- 2. Construct the payload ---
+    if args.binary:
+        # Send the file as is, with the HPO IDs as a comma-separated form field
+        url = args.url.rstrip('/') + "/upload"
+        request_kwargs = {
+            "files": {"img": (os.path.basename(args.image_path), image_bytes, "application/octet-stream")},
+            "data": {"hpo_ids": args.hpo} if args.hpo else {},
+        }
+    else:
+        # Encode image to Base64 and decode to a UTF-8 string for the JSON payload
+        payload = {
+            "img": base64.b64encode(image_bytes).decode('utf-8')
+        }
+        if args.hpo:
+            # Split the comma-separated string into a list of HPO IDs
+            hpo_ids = [hpo_id.strip() for hpo_id in args.hpo.split(',')]
+            payload["hpo_ids"] = hpo_ids
+        url = args.url
+        request_kwargs = {"json": payload}
 
     # --- 3. Make the API request ---
     try:
         print("Sending request to API...", file=sys.stderr)
         response = requests.post(
-            args.url,
-            json=payload,
+            url,
+            **request_kwargs,
             auth=HTTPBasicAuth(args.user, args.password),
             # Disable SSL verification if --no-verify is used
             verify=not args.no_verify,
@@ -18,8 +18,8 @@ from albumentations.pytorch import ToTensorV2
 from onnx2torch import convert
 
 from lib.models.my_arcface import MyArcFace
+from lib.encode import preprocess_tta, forward_tta
 import torch.nn.functional as F
-import albumentations as A
 import torch.backends.cudnn as cudnn
 
 
@@ -34,26 +34,6 @@ def normalize(img, type='float'):
     return normalized
 
 
-# Preprocessing used for ArcFace input image inference
-def preprocess(img, img_size=112, gray=False, flip=False):
-    img = cv2.resize(img, (img_size, img_size))
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-    if gray:
-        # desired number of channels is 1, so we convert to gray
-        img = A.to_gray(img)
-    # else: color
-
-    if flip:
-        img = A.hflip(img)
-    # else: normal
-
-    img = np.transpose(img, (2, 0, 1))
-    img = torch.from_numpy(img).unsqueeze(0).float()
-    img.div_(255).sub_(0.5).div_(0.5)
-    return img
-
-
 def parse_args():
     parser = argparse.ArgumentParser(description='Encode aligned images using GestaltMatcher-Arc ensemble')
 
@@ -132,31 +112,22 @@ def predict(models, device, img_paths, args):
                     f = open(os.path.join(args.save_dir, f"{img_name.rsplit('_', 1)[0]}_encoding.csv"), "w+")
                     f.write(f"img_name;model;flip;gray;class_conf;representations\n")
 
+            # all flip/gray variants are preprocessed once and encoded in a single batch per model
+            img_p, tta_modes = preprocess_tta(img, img_size)
+            img_p = img_p.to(device, dtype=torch.float32)
             for idx, model in enumerate(models):
-                for flip in [False, True]:
-                    for gray in [False, True]:
-                        img_p = preprocess(img,
-                                           img_size,
-                                           gray=gray,
-                                           flip=flip,
-                                           ).to(device, dtype=torch.float32)
-
-                        pred_rep = model(img_p)
-                        if len(pred_rep) == 1:  # type == onnx --> 1 output: pred_rep
-                            pred = [0]
-                        else:  # type == pth --> 2 outputs: pred, pred_rep
-                            pred, pred_rep = pred_rep
-                            pred = pred.squeeze().tolist()
-
-                        # TODO:
-                        # check if we want to normalize (pred_rep = F.normalize(pred_rep))
-                        # check if we want to use half-precision: has similar or better acc. and smaller size on disk
-
-                        if args.save_as_pickle:
-                            df.loc[len(df)] = [img_name, f"m{idx}", int(flip), int(gray), pred,
-                                               pred_rep.squeeze().tolist()]
-                        else:  # csv-file
-                            f.write(f"{img_name};m{idx};{int(flip)};{int(gray)};{pred};{pred_rep.squeeze().tolist()}\n")
+                preds, pred_reps = forward_tta(model, img_p)
+                preds = [[0]] * len(tta_modes) if preds is None else preds.tolist()
+                for (flip, gray), pred, pred_rep in zip(tta_modes, preds, pred_reps):
+                    # TODO:
+                    # check if we want to normalize (pred_rep = F.normalize(pred_rep))
+                    # check if we want to use half-precision: has similar or better acc. and smaller size on disk
+
+                    if args.save_as_pickle:
+                        df.loc[len(df)] = [img_name, f"m{idx}", int(flip), int(gray), pred,
+                                           pred_rep.tolist()]
+                    else:  # csv-file
+                        f.write(f"{img_name};m{idx};{int(flip)};{int(gray)};{pred};{pred_rep.tolist()}\n")
 
             if args.separate_outputs and args.save_as_pickle:
                 df.to_pickle(os.path.join(args.save_dir, f"{img_name.rsplit('_', 1)[0]}_encoding.pkl"))
@@ -12,34 +12,13 @@ import torch
 import numpy as np
 from onnx2torch import convert
 import torch.nn.functional as F
-import albumentations as A
 
 from lib.models.my_arcface import MyArcFace
+from lib.encode import preprocess_tta, forward_tta
 
 saved_model_dir = "saved_models"
 
 
-# Preprocessing used for ArcFace input image inference
-def preprocess(img, img_size=112, gray=False, flip=False):
-    img = cv2.resize(img, (img_size, img_size))
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-    if gray:
-        # desired number of channels is 1, so we convert to gray
-        img = A.to_gray(img)
-    #else: color
-
-    if flip:
-        img = A.hflip(img)
-    #else: normal
-
-    # normalize pixel values in range [-1,1]
-    img = np.transpose(img, (2, 0, 1))
-    img = torch.from_numpy(img).unsqueeze(0).float()
-    img.div_(255).sub_(0.5).div_(0.5)
-    return img
-
-
 def parse_args():
     parser = argparse.ArgumentParser(description='Predict GestaltMatcher-Arc Ensemble')
     parser.add_argument('--no_cuda', action='store_true', default=False,
@@ -67,24 +46,16 @@ def predict(models, device, data, args):
             print(f"{img_path=}")
             img = cv2.imread(os.path.join(args.data_dir, img_path))
 
+            # all flip/gray variants are preprocessed once and encoded in a single batch per model
+            img_p, tta_modes = preprocess_tta(img)
+            img_p = img_p.to(device, dtype=torch.float32)
             for idx, model in enumerate(models):
-                for flip in [False,True]:
-                    for gray in [False,True]:
-                        img_p = preprocess(img,
-                                           gray=gray,
-                                           flip=flip
-                                           ).to(device, dtype=torch.float32)
-
-                        pred_rep = model(img_p)
-                        if len(pred_rep) == 1:  #type == onnx --> 1 output: pred_rep
-                            pred = [0]
-                        else:
-                            pred, pred_rep = pred_rep
-                            pred = pred.squeeze().tolist()
-
-                        pred_rep = F.normalize(pred_rep)
-                        f.write(f"{img_path};m{idx};{int(flip)};{int(gray)};"
-                                f"{pred};{pred_rep.squeeze().tolist()}\n")
+                preds, pred_reps = forward_tta(model, img_p)
+                preds = [[0]] * len(tta_modes) if preds is None else preds.tolist()
+                pred_reps = F.normalize(pred_reps)
+                for (flip, gray), pred, pred_rep in zip(tta_modes, preds, pred_reps):
+                    f.write(f"{img_path};m{idx};{int(flip)};{int(gray)};"
+                            f"{pred};{pred_rep.tolist()}\n")
 
     f.flush()
     f.close()
@@ -17,35 +17,70 @@ def parse_args():
                         help='URL to the api.')
     parser.add_argument('--port', default=5000, dest='port',
                         help='Port to the api.')
-    return parser.parse_args()
-
-
-def analyze_image(input_file, output_dir, api_endpoint):
+    parser.add_argument('--binary', action='store_true', dest='binary',
+                        help='Upload the image files as multipart/form-data instead of base64 in JSON.')
+    parser.add_argument('--batch_size', default=1, type=int, dest='batch_size',
+                        help='Number of images sent per request to /api/predict/batch (1 uses /api/predict). '
+                             '/api/predict/batch only accepts base64 images, so it cannot be combined with --binary.')
+    args = parser.parse_args()
+    if args.binary and args.batch_size > 1:
+        parser.error('--binary cannot be combined with --batch_size, /api/predict/batch only accepts base64 images')
+    return args
+
+
+def analyze_image(input_file, output_dir, api_endpoint, binary=False):
     file_predix = Path(input_file).stem
     with open(input_file, "rb") as f:
         img_raw_original = f.read()
 
-    encode_image = base64.b64encode(img_raw_original)
-    encode_image_str = encode_image.decode("utf-8")
+    auth = requests.auth.HTTPBasicAuth('your_username', 'your_password')
+    if binary:
+        # send the file as is to the upload endpoint
+        files = {"img": (Path(input_file).name, img_raw_original, "application/octet-stream")}
+        r = requests.post(url=api_endpoint + "/upload", files=files, auth=auth)
+    else:
+        encode_image = base64.b64encode(img_raw_original)
+        encode_image_str = encode_image.decode("utf-8")
 
-    # defining a params dict for the parameters to be sent to the API
-    PARAMS = {"img": encode_image_str}
+        # defining a params dict for the parameters to be sent to the API
+        PARAMS = {"img": encode_image_str}
 
-    auth = requests.auth.HTTPBasicAuth('your_username', 'your_password')
-    r = requests.post(url=api_endpoint, json=PARAMS, auth=auth)
+        r = requests.post(url=api_endpoint, json=PARAMS, auth=auth)
     # extracting data in json format
     status = r.status_code
     data = r.json()
     if status != 200:
         print(data)
     else:
-        output_data = {}
-        output_data['case_id'] = file_predix
-        for key, value in data.items():
-            output_data[key] = value
-        output_filename = os.path.join(output_dir, "{}.json".format(file_predix))
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=4)
+        save_result(data, file_predix, output_dir)
+
+
+def analyze_images(input_files, output_dir, api_endpoint):
+    # analyze several images with one request to the batch endpoint
+    images = []
+    for input_file in input_files:
+        with open(input_file, "rb") as f:
+            images.append({"img": base64.b64encode(f.read()).decode("utf-8")})
+
+    auth = requests.auth.HTTPBasicAuth('your_username', 'your_password')
+    r = requests.post(url=api_endpoint + "/batch", json={"images": images}, auth=auth)
+    status = r.status_code
+    data = r.json()
+    if status != 200:
+        print(data)
+    else:
+        for input_file, result in zip(input_files, data["results"]):
+            save_result(result, Path(input_file).stem, output_dir)
+
+
+def save_result(data, file_predix, output_dir):
+    output_data = {}
+    output_data['case_id'] = file_predix
+    for key, value in data.items():
+        output_data[key] = value
+    output_filename = os.path.join(output_dir, "{}.json".format(file_predix))
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        json.dump(output_data, f, ensure_ascii=False, indent=4)
 
 
 def main():
@@ -66,15 +101,22 @@ def main():
     # single file
     if single_file:
         print("Start processing {} file.".format(1))
-        analyze_image(args.case_input, args.output_dir, predict_URL)
+        analyze_image(args.case_input, args.output_dir, predict_URL, args.binary)
         print("Finished (1/1): {}".format(args.case_input))
     else:
         input_files = os.listdir(args.case_input)
         print("Start processing {} file.".format(len(input_files)))
         count = 1
+        if args.batch_size > 1:
+            input_files = [os.path.join(args.case_input, input_file) for input_file in input_files]
+            for start in range(0, len(input_files), args.batch_size):
+                batch_files = input_files[start:start + args.batch_size]
+                analyze_images(batch_files, args.output_dir, predict_URL)
+                print("Finished ({}/{})".format(start + len(batch_files), len(input_files)))
+            input_files = []
         for input_file in input_files:
             filename = os.path.join(args.case_input, input_file)
-            analyze_image(filename, args.output_dir, predict_URL)
+            analyze_image(filename, args.output_dir, predict_URL, args.binary)
             print("Finished ({}/{}): {}".format(count, len(input_files), filename))
             count += 1
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the service modules as the service does, from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import types
+
+import pytest
+
+# main loads the models' dependencies and config.json of the backend directory
+pytest.importorskip("onnx2torch")
+pytest.importorskip("torchvision")
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.fixture
+def started_queries(monkeypatch):
+    queries = []
+    monkeypatch.setattr(main, 'start_pubcasefinder_query', lambda hpo_ids: queries.append(hpo_ids))
+    return queries
+
+
+@pytest.mark.parametrize("ready, running", [(False, 0), (True, 1)])
+def test_rejected_requests_send_no_pubcasefinder_queries(monkeypatch, started_queries, ready, running):
+    # starting up, or a single worker busy without room to wait
+    pool = main.InferencePool(1, 0)
+    pool._pending = running
+    monkeypatch.setattr(main, '_loader', types.SimpleNamespace(ready=ready))
+    monkeypatch.setattr(main, '_inference_pool', pool, raising=False)
+    options = {'hpo_ids': ['HP:0000252']}
+    requests = [main.start_predict(main.PredictOptions(**options), 'img'),
+                main.predict_batch_endpoint('user', main.PredictBatchRequest(images=[{'img': 'img'}], **options), None),
+                main.predict_patient_endpoint('user', main.PredictPatientRequest(images=['img'], **options), None)]
+    for request in requests:
+        with pytest.raises(main.HTTPException) as e:
+            asyncio.run(request)
+        assert e.value.status_code == 503
+    assert started_queries == []
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from lib.circuit_breaker import CircuitBreaker
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow_request()
+        breaker.record_failure()
+
+
+def test_trips_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+    trip(breaker)
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+    assert not breaker.allow_request()
+    assert breaker.rejected == 1
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.1)
+    trip(breaker)
+    time.sleep(0.15)
+    assert breaker.state == "half_open"
+
+    allowed = []
+    threads = [threading.Thread(target=lambda: allowed.append(breaker.allow_request())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert allowed.count(True) == 1
+    assert breaker.rejected == 7
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert all(breaker.allow_request() for _ in range(5))
+
+
+def test_failed_probe_trips_again():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.1)
+    trip(breaker)
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.trips == 2
+
+
+def test_stuck_probe_is_replaced_after_cooldown():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.1)
+    trip(breaker)
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    # the probe never recorded its outcome
+    time.sleep(0.15)
+    assert breaker.allow_request()
@@ -0,0 +1,55 @@
+import copy
+import random
+
+from lib.integrator import integrate_json
+
+LIST_KEYS = ('suggested_syndromes_list', 'suggested_genes_list', 'suggested_patients_list')
+
+
+def make_result(n=200, seed=0):
+    rng = random.Random(seed)
+    omim_ids = [str(100000 + rng.randrange(50)) for _ in range(n)]
+    return {
+        'suggested_syndromes_list': [{'omim_id': omim_id, 'distance': i / n} for i, omim_id in enumerate(omim_ids)],
+        'suggested_genes_list': [{'gene_name': f'G{rng.randrange(50)}', 'distance': i / n} for i in range(n)],
+        'suggested_patients_list': [{'omim_id': rng.choice([f'{omim_id}, PS{omim_id}', omim_id, None]),
+                                     'distance': i / n} for i, omim_id in enumerate(omim_ids)],
+        'pubcasefinder': {'ranked_list': [{'id': f'OMIM:{100000 + rng.randrange(50)}', 'rank': rank,
+                                           'score': 1.0 / rank, 'hgnc_gene_symbol': [f'G{rng.randrange(50)}']}
+                                          for rank in range(1, 40)]},
+    }
+
+
+def test_meta_rank_orders_by_mean_rank():
+    result = integrate_json(make_result())
+    for key in LIST_KEYS:
+        items = result[key]
+        assert [item['meta_rank'] for item in items] == list(range(1, len(items) + 1))
+        ranked = [item for item in items if item['mean_rank'] is not None]
+        # items with a mean rank come first, in mean rank order and ties in GestaltMatcher order
+        assert items[:len(ranked)] == ranked
+        assert ranked == sorted(ranked, key=lambda item: (item['mean_rank'], item['gm_rank']))
+        assert all(item['mean_rank'] == (item['gm_rank'] + item['pubcasefinder_rank']) / 2 for item in ranked)
+        unranked = items[len(ranked):]
+        assert [item['gm_rank'] for item in unranked] == sorted(item['gm_rank'] for item in unranked)
+
+
+def test_top_n_returns_the_first_entries():
+    raw = make_result()
+    full = integrate_json(copy.deepcopy(raw))
+    for top_n in (0, 1, 7, 200, 500):
+        assert all(integrate_json(copy.deepcopy(raw), top_n=top_n)[key] == full[key][:top_n] for key in LIST_KEYS)
+
+    limited = integrate_json(copy.deepcopy(raw), top_n={'suggested_genes_list': 5})
+    assert limited['suggested_genes_list'] == full['suggested_genes_list'][:5]
+    assert limited['suggested_syndromes_list'] == full['suggested_syndromes_list']
+
+
+def test_patients_match_the_numeric_omim_id():
+    result = integrate_json({'suggested_patients_list': [{'omim_id': '100001, PS100000', 'distance': 0.1},
+                                                         {'omim_id': 'PS100000', 'distance': 0.2}],
+                             'pubcasefinder': {'ranked_list': [{'id': 'OMIM:100001', 'rank': 3, 'score': 0.5}]}})
+    first, second = result['suggested_patients_list']
+    assert (first['numeric_omim_id'], first['phenotypic_series_id']) == (100001, 'PS100000')
+    assert (first['pubcasefinder_rank'], first['mean_rank']) == (3, 2.0)
+    assert (second['numeric_omim_id'], second['phenotypic_series_id'], second['mean_rank']) == (None, 'PS100000', None)
@@ -0,0 +1,43 @@
+import asyncio
+import gzip
+import threading
+
+import numpy as np
+import orjson
+from starlette.requests import Request
+
+from lib import json_response
+from lib.json_response import FastJSONResponse
+
+
+def gzip_request():
+    return Request({"type": "http", "headers": [(b"accept-encoding", b"gzip")]})
+
+
+def test_create_matches_the_constructor():
+    for content in ({"score": np.float32(0.5)}, {"items": list(range(50000))}):
+        created = asyncio.run(FastJSONResponse.create(content, gzip_request()))
+        built = FastJSONResponse(content, gzip_request())
+        assert created.body == built.body
+        assert created.headers == built.headers
+        assert orjson.loads(gzip.decompress(created.body) if "content-encoding" in created.headers
+                            else created.body) == orjson.loads(json_response.dumps(content))
+
+
+def test_large_bodies_are_compressed_off_the_event_loop(monkeypatch):
+    compressed_in = []
+
+    def compress(body, encoding):
+        compressed_in.append(threading.current_thread())
+        return gzip.compress(body)
+
+    monkeypatch.setattr(json_response, "compress", compress)
+
+    async def respond(content):
+        await FastJSONResponse.create(content, gzip_request())
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(respond({"pad": "x" * 2000}))
+    assert compressed_in == [loop_thread]
+    loop_thread = asyncio.run(respond({"pad": "x" * json_response.THREAD_COMPRESS_MIN_BYTES}))
+    assert compressed_in[1] is not loop_thread
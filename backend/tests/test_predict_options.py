@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+# main loads the models' dependencies and config.json of the backend directory
+pytest.importorskip("onnx2torch")
+pytest.importorskip("torchvision")
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.mark.parametrize("budget", [0, -1, -0.5])
+def test_budget_must_be_positive(budget):
+    with pytest.raises(ValueError):
+        main.PredictOptions(pubcasefinder_budget=budget)
+
+
+def test_budget_default():
+    assert main.pubcasefinder_deadline(main.PredictOptions()) == pytest.approx(
+        main.time.monotonic() + main.PUBCASEFINDER_BUDGET, abs=0.5)
+    assert main.pubcasefinder_deadline(main.PredictOptions(pubcasefinder_budget=0.5)) == pytest.approx(
+        main.time.monotonic() + 0.5, abs=0.2)
+
+
+@pytest.mark.parametrize("field", ["top_n", "syndromes_top_n", "genes_top_n", "patients_top_n"])
+def test_top_n_must_not_be_negative(field):
+    with pytest.raises(ValueError):
+        main.PredictOptions(**{field: -1})
+    assert getattr(main.PredictOptions(**{field: 0}), field) == 0
@@ -0,0 +1,54 @@
+import base64
+import os
+
+import pytest
+
+# main loads the models' dependencies and config.json of the backend directory
+pytest.importorskip("onnx2torch")
+pytest.importorskip("torchvision")
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.fixture
+def patient_pipeline(monkeypatch):
+    # the face detector fails on images starting with b'noface'; encodings and the gallery search are stubbed
+    def face_align_crop(cropper_model, img, device):
+        if img.startswith(b'noface'):
+            raise ValueError("No face detected")
+        return b'aligned:' + img
+
+    searched = []
+
+    def predict_patient(encodings, *args):
+        searched.append(encodings)
+        return {'suggested_syndromes_list': [], 'suggested_genes_list': [], 'suggested_patients_list': []}
+
+    monkeypatch.setattr(main, 'decode_img', lambda img_bytes: img_bytes)
+    monkeypatch.setattr(main, 'face_align_crop', face_align_crop)
+    monkeypatch.setattr(main, 'encode_batch', lambda models, device, imgs, *flags: [b'encoding:' + img for img in imgs])
+    monkeypatch.setattr(main, 'predict_patient', predict_patient)
+    # created at startup; the stubs above do not use the models and gallery
+    monkeypatch.setattr(main, '_result_cache', main.ResultCache(1024 * 1024), raising=False)
+    for name in ('_models', '_cropper_model', '_device', '_gallery_df', '_images_synds_dict', '_images_genes_dict',
+                 '_genes_metadata_dict', '_synds_metadata_dict', '_gallery_representations', '_gallery_labels',
+                 '_gallery_index'):
+        monkeypatch.setattr(main, name, None, raising=False)
+    return searched
+
+
+def patient_request(*images):
+    return main.PredictPatientRequest(images=[base64.b64encode(img).decode() for img in images])
+
+
+def test_skipped_image_keeps_the_keys_of_the_others(patient_pipeline):
+    first = main.run_predict_patient(patient_request(b'noface1', b'patient A'))
+    second = main.run_predict_patient(patient_request(b'noface2', b'patient B'))
+
+    assert first['skipped_images'] == [0] and second['skipped_images'] == [0]
+    assert patient_pipeline == [[b'encoding:aligned:patient A'], [b'encoding:aligned:patient B']]
+    for img in (b'patient A', b'patient B'):
+        key = main.hash_image(img)
+        assert main._result_cache.get(key, 'aligned') == b'aligned:' + img
+        assert main._result_cache.get(key, ('encoding', False, False)) == b'encoding:aligned:' + img
+    assert main._result_cache.get(None, 'aligned') is None
@@ -0,0 +1,219 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import httpx
+import pytest
+
+from lib import pubcasefinder
+
+RANKED_LIST = [{"id": "OMIM:122470", "score": 0.9}]
+HPO_NAMES = {"HP:0000316": {"name_en": "Hypertelorism"}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so the client can reuse its connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((urlparse(self.path).path, self.client_address))
+        time.sleep(self.server.delay)
+        if urlparse(self.path).path == pubcasefinder.PCF_RANKED_LIST_API_PATH:
+            body = json.dumps(RANKED_LIST).encode()
+        else:
+            body = json.dumps(HPO_NAMES).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """Local PubCaseFinder stand-in; set server.delay to answer slowly."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.delay = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_module():
+    pubcasefinder.configure_cache()
+    pubcasefinder.configure_circuit_breaker()
+    yield
+    pubcasefinder.close_client()
+
+
+def test_connection_is_reused_across_calls(stub_server):
+    pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    for _ in range(3):
+        assert pubcasefinder._fetch_ranked_list(["HP:0000316"]) == RANKED_LIST
+        assert pubcasefinder._fetch_hpo_names(["HP:0000316"]) == HPO_NAMES
+
+    assert len(stub_server.requests) == 6
+    # all requests came over the same client socket
+    assert len({client_address for _, client_address in stub_server.requests}) == 1
+
+
+def test_query_against_stub(stub_server):
+    pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    result = pubcasefinder.query_pubcasefinder(["HP:0000316"])
+    assert result == {"ranked_list": RANKED_LIST, "hpo_names": HPO_NAMES}
+
+
+def test_read_timeout(stub_server):
+    stub_server.delay = 1.0
+    pubcasefinder.open_client(base_url=stub_server.url, read_timeout=0.2, http2=False)
+    start = time.monotonic()
+    with pytest.raises(httpx.ReadTimeout):
+        pubcasefinder._fetch_ranked_list(["HP:0000316"])
+    assert time.monotonic() - start < 0.9
+
+
+def test_connect_timeout():
+    # a listening socket whose accept backlog is full: the handshake never completes
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    fillers = []
+    try:
+        for _ in range(4):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(listener.getsockname())
+            fillers.append(filler)
+        pubcasefinder.open_client(base_url="http://{}:{}".format(*listener.getsockname()),
+                                  connect_timeout=0.2, read_timeout=5, http2=False)
+        assert pubcasefinder._get_client().timeout.connect == 0.2
+        start = time.monotonic()
+        with pytest.raises(httpx.ConnectTimeout):
+            pubcasefinder._fetch_ranked_list(["HP:0000316"])
+        assert time.monotonic() - start < 2
+    finally:
+        for filler in fillers:
+            filler.close()
+        listener.close()
+
+
+def test_close_client_on_shutdown(stub_server):
+    client = pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    pubcasefinder._fetch_ranked_list(["HP:0000316"])
+    pubcasefinder.close_client()
+
+    assert client.is_closed
+    # a query outliving the shutdown does not silently open a new client, and degrades to no HPO ranking
+    with pytest.raises(pubcasefinder.ClientClosedError):
+        pubcasefinder._fetch_ranked_list(["HP:0000316"])
+    query = pubcasefinder.start_pubcasefinder_query(["HP:0000316"])
+    assert pubcasefinder.collect_pubcasefinder_query(query) == {
+        "error": "The PubCaseFinder API is temporarily unavailable."}
+    assert len(stub_server.requests) == 1
+
+    pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    assert pubcasefinder._fetch_ranked_list(["HP:0000316"]) == RANKED_LIST
+
+
+def test_mock_transport():
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, json=RANKED_LIST)
+
+    pubcasefinder.open_client(base_url="http://pcf.test", transport=httpx.MockTransport(handler))
+    assert pubcasefinder._fetch_ranked_list(["HP:0000316"]) == RANKED_LIST
+    assert paths == [pubcasefinder.PCF_RANKED_LIST_API_PATH]
+
+
+def test_slow_query_counts_one_failure_per_call(stub_server):
+    # a query over budget whose two API calls later hit their read timeout
+    stub_server.delay = 0.5
+    pubcasefinder.open_client(base_url=stub_server.url, read_timeout=0.2, http2=False)
+    query = pubcasefinder.start_pubcasefinder_query(["HP:0000316"])
+    result = pubcasefinder.collect_pubcasefinder_query(query, deadline=time.monotonic() + 0.01)
+    assert "error" in result
+    # the exceeded budget itself is not a failure
+    assert pubcasefinder.breaker_stats()["consecutive_failures"] == 0
+
+    for future in query:
+        with pytest.raises(httpx.ReadTimeout):
+            future.result()
+    stats = pubcasefinder.breaker_stats()
+    assert stats["consecutive_failures"] == 2
+    assert stats["trips"] == 0
+    assert stats["state"] == "closed"
+
+
+def test_expired_budget_does_not_trip_breaker(stub_server):
+    stub_server.delay = 0.2
+    pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    for i in range(5):
+        query = pubcasefinder.start_pubcasefinder_query([f"HP:000031{i}"])
+        assert "error" in pubcasefinder.collect_pubcasefinder_query(query, deadline=time.monotonic())
+    # the slow calls still succeed, so the breaker stays closed
+    time.sleep(0.5)
+    stats = pubcasefinder.breaker_stats()
+    assert stats["consecutive_failures"] == 0
+    assert stats["trips"] == 0
+
+
+def test_half_open_sends_one_probe(stub_server):
+    pubcasefinder.configure_circuit_breaker(failure_threshold=1, cooldown=0.1)
+    pubcasefinder.open_client(base_url=stub_server.url, http2=False)
+    pubcasefinder._breaker.record_failure()
+    assert pubcasefinder.breaker_stats()["state"] == "open"
+    time.sleep(0.15)
+
+    stub_server.delay = 0.2
+    queries = [pubcasefinder.start_pubcasefinder_query([f"HP:000031{i}"]) for i in range(3)]
+    results = [pubcasefinder.collect_pubcasefinder_query(query) for query in queries]
+    # one probe request reached the API, the rest were rejected while it ran
+    assert len(stub_server.requests) == 1
+    assert all("error" in result for result in results)
+    assert pubcasefinder.breaker_stats()["state"] == "closed"
+    assert "error" not in pubcasefinder.query_pubcasefinder(["HP:0000316"])
+
+
+def status_transport(status_code):
+    return httpx.MockTransport(lambda request: httpx.Response(status_code, json={"message": "error"}))
+
+
+def test_client_errors_do_not_trip_breaker():
+    pubcasefinder.configure_circuit_breaker(failure_threshold=2, cooldown=60)
+    pubcasefinder.open_client(base_url="http://pcf.test", transport=status_transport(400))
+    for i in range(5):
+        result = pubcasefinder.query_pubcasefinder([f"HP:bad{i}"])
+        assert result == {"error": "Failed to connect to the PubCaseFinder API."}
+    stats = pubcasefinder.breaker_stats()
+    assert (stats["state"], stats["consecutive_failures"], stats["trips"]) == ("closed", 0, 0)
+
+
+def test_server_errors_trip_breaker():
+    pubcasefinder.configure_circuit_breaker(failure_threshold=2, cooldown=60)
+    pubcasefinder.open_client(base_url="http://pcf.test", transport=status_transport(503))
+    assert "error" in pubcasefinder.query_pubcasefinder(["HP:0000316"])
+    assert pubcasefinder.breaker_stats()["state"] == "open"
+
+
+def test_client_error_probe_lets_the_next_call_probe():
+    pubcasefinder.configure_circuit_breaker(failure_threshold=1, cooldown=0.1)
+    pubcasefinder.open_client(base_url="http://pcf.test", transport=status_transport(404))
+    pubcasefinder._breaker.record_failure()
+    time.sleep(0.15)
+    with pytest.raises(httpx.HTTPStatusError):
+        pubcasefinder._fetch_ranked_list(["HP:0000316"])
+    assert pubcasefinder._breaker.allow_request()
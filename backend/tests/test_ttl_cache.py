@@ -0,0 +1,36 @@
+import os
+import time
+
+import numpy as np
+
+from lib import ttl_cache
+from lib.ttl_cache import TTLCache
+
+
+def test_workers_share_the_disk_tier(tmp_path):
+    # two workers: separate processes with their own memory tier on the same directory
+    first = TTLCache(4, 60, str(tmp_path))
+    second = TTLCache(4, 60, str(tmp_path))
+    first.put("result", {"items": [{"distance": np.float32(0.5), "gm_rank": np.int64(1)}]})
+    assert second.get("result") == {"items": [{"distance": 0.5, "gm_rank": 1}]}
+    assert second.get("missing") is None
+
+
+def test_expired_entries_are_not_read(tmp_path):
+    cache = TTLCache(4, 0.05, str(tmp_path))
+    cache.put("result", [1, 2])
+    time.sleep(0.1)
+    assert cache.get("result") is None
+    assert TTLCache(4, 0.05, str(tmp_path)).get("result") is None
+
+
+def test_expired_files_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(ttl_cache, "DISK_PRUNE_INTERVAL", 0)
+    cache = TTLCache(4, 60, str(tmp_path))
+    cache.put("old", [1])
+    cache.put("new", [2])
+    old_path = cache._disk_path("old")
+    os.utime(old_path, (time.time() - 120, time.time() - 120))
+    cache.put("newer", [3])
+    assert not os.path.exists(old_path)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(cache._disk_path(key)) for key in ("new", "newer"))